@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Compares the connections opened by a harvest job with the pooled sessions
+of ckanext.geocat.metadata and with a new connection per request (owslib).
+
+A local CSW mock serves the GetRecords and GetRecordById fixtures. Like the
+harvester, the job gathers the ids and then fetches every record with a
+new CswHelper. For both modes the number of accepted connections (i.e.
+TCP handshakes) and the time per job are printed.
+
+Usage: python bin/benchmark_csw_sessions.py [records]
+"""
+import BaseHTTPServer
+import SocketServer
+import os
+import sys
+import threading
+import time
+
+from owslib.csw import CatalogueServiceWeb
+import ckanext.geocat.metadata as md
+
+FIXTURES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..', 'ckanext', 'geocat', 'tests', 'fixtures'
+)
+
+connections = [0]
+
+
+def _read(filename):
+    with open(os.path.join(FIXTURES, filename)) as f:
+        return f.read()
+
+
+class CswHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    responses_by_method = {
+        'POST': _read('response_all_results.xml'),
+        'GET': _read('result_1.xml'),
+    }
+
+    def setup(self):
+        connections[0] += 1
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def _respond(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self.rfile.read(length)
+        body = self.responses_by_method[self.command]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class CswServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def run_job(url, records):
+    csw = md.CswHelper(url=url)
+    ids = list(csw.get_id_by_search(cql="keyword = 'opendata.swiss'"))
+    for number in xrange(records):
+        md.CswHelper(url=url).get_by_id(ids[number % len(ids)])
+
+
+def main(records):
+    server = CswServer(('127.0.0.1', 0), CswHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/csw' % server.server_address[1]
+
+    pooled_invoke = md.GeocatCatalogueServiceWeb._invoke
+    print '%-10s %8s %12s %10s' % ('mode', 'records', 'connections', 'ms/job')  # noqa
+    for mode in ('owslib', 'pooled'):
+        if mode == 'owslib':
+            md.GeocatCatalogueServiceWeb._invoke = CatalogueServiceWeb._invoke
+        else:
+            md.GeocatCatalogueServiceWeb._invoke = pooled_invoke
+        md._sessions.clear()
+        connections[0] = 0
+        start = time.time()
+        run_job(url, records)
+        print '%-10s %8d %12d %10.1f' % (
+            mode,
+            records,
+            connections[0],
+            (time.time() - start) * 1000
+        )
+        for session in md._sessions.values():
+            session.close()
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
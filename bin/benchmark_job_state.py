@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Compares the per-object overhead of the harvester with and without the
+HarvestJobState of ckanext.geocat.harvester.
+
+Without the job state, every fetched and imported object parsed the config
+of the source, read the permalink settings and built the package schemas.
+With the job state this is done once per job. The source config is the one
+of a typical geocat source with an organization, so no database or search
+requests are needed; the saved get_site_user and package_show requests
+come on top of the printed times.
+
+Needs ckanext-harvest, i.e. run it in the virtualenv of CKAN.
+
+Usage: python bin/benchmark_job_state.py [objects]
+"""
+import json
+import sys
+import time
+
+from ckanext.geocat.harvester import GeocatHarvester, HarvestJobState
+
+CONFIG = json.dumps({
+    'organization': 'geocat_org',
+    'cql': "keyword = 'opendata.swiss'",
+    'delete_missing_datasets': True,
+    'legal_basis_url': 'https://www.admin.ch/opc/de/classified-compilation/',
+    'rights': 'NonCommercialAllowed-CommercialAllowed-ReferenceRequired',
+})
+
+
+class Source(object):
+    config = CONFIG
+
+
+class Job(object):
+    id = 'job'
+    source = Source()
+    source_id = 'source'
+
+
+def per_object(harvester, job):
+    """ The state computed for every object (before the job state) """
+    harvester._set_config(job.source.config)
+    HarvestJobState(job.source.config, harvester.config)
+
+
+def per_job(harvester, job):
+    harvester._load_job_state(job)
+
+
+def main(objects):
+    job = Job()
+    print '%-12s %8s %14s' % ('mode', 'objects', 'us/object')
+    for mode, load in (('per object', per_object), ('per job', per_job)):
+        harvester = GeocatHarvester()
+        start = time.time()
+        for _ in xrange(objects):
+            # once for the fetch and once for the import stage
+            load(harvester, job)
+            load(harvester, job)
+        print '%-12s %8d %14.1f' % (
+            mode,
+            objects,
+            (time.time() - start) * 1000000 / objects
+        )
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Compares the extraction of a dataset and its distributions with and without
+the locale index of ckanext.geocat.xml_loader.
+
+For every fixture the number of XPath evaluations (i.e. traversals of the
+tree) and the time per record are printed.
+
+Usage: python bin/benchmark_locale_index.py [fixture ...]
+"""
+import os
+import re
+import sys
+import timeit
+
+import ckanext.geocat.metadata as md
+import ckanext.geocat.xml_loader as loader
+
+FIXTURES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..', 'ckanext', 'geocat', 'tests', 'fixtures'
+)
+RUNS = 200
+
+evaluations = [0]
+compile_xpath = loader.compile_xpath
+localised = loader.LOCALISED
+
+
+class CountingXPath(object):
+    def __init__(self, xpath):
+        self.xpath = xpath
+
+    def __call__(self, xml):
+        evaluations[0] += 1
+        return self.xpath(xml)
+
+
+def setup(use_index):
+    """ Resets all caches and builds the mappings again """
+    loader._compiled_xpaths.clear()
+    loader._anchored_xpaths.clear()
+    loader._indexed_xpaths.clear()
+    loader.compile_xpath = lambda xpath: CountingXPath(compile_xpath(xpath))
+    loader.LOCALISED = localised if use_index else re.compile('(?!)')
+    # the values of the mappings compile their expressions when the
+    # module is loaded, so it is loaded again with the patched loader
+    reload(md)
+
+
+def extract(xml):
+    context = md.ExtractionContext(xml)
+    md.GeocatDcatDatasetMetadata().get_metadata(context)
+    md.GeocatDcatDistributionMetadata().get_metadata(context)
+
+
+def main(filenames):
+    print '%-20s %-10s %12s %12s' % ('fixture', 'index', 'evaluations', 'ms/record')  # noqa
+    for filename in filenames:
+        with open(os.path.join(FIXTURES, filename)) as f:
+            xml = loader.from_string(f.read())
+        for use_index in (False, True):
+            setup(use_index)
+            extract(xml)
+            evaluations[0] = 0
+            extract(xml)
+            count = evaluations[0]
+            seconds = timeit.timeit(lambda: extract(xml), number=RUNS)
+            print '%-20s %-10s %12d %12.2f' % (
+                filename,
+                'on' if use_index else 'off',
+                count,
+                seconds / RUNS * 1000
+            )
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or ['complete.xml', 'only_de.xml'])
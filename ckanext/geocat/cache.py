@@ -0,0 +1,174 @@
+"""
+On-disk cache of CSW responses.
+
+The responses are stored by a key of the endpoint and the request (the
+URL with the query string and the body of POST requests), which includes
+the ids of GetRecordById requests and the start position of GetRecords
+pages. A response is used without a request for `ttl` seconds, after that
+it is revalidated with a conditional request, if the server sent an ETag
+or Last-Modified header. If the cache grows beyond `max_size` bytes, the
+least recently used responses are removed.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class CacheEntry(object):
+    """ A cached response and its metadata """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+
+    def is_fresh(self, ttl):
+        return time.time() - self.meta['stored'] < ttl
+
+    def get_conditional_headers(self):
+        """ Returns the headers to revalidate the response """
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('last_modified'):
+            headers['If-Modified-Since'] = self.meta['last_modified']
+        return headers
+
+    def get_response(self):
+        """ Returns the cached response as requests.Response """
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        response = requests.Response()
+        response.status_code = 200
+        response.url = self.meta['url']
+        response._content = content
+        return response
+
+
+class ResponseCache(object):
+    def __init__(self, path, ttl=86400, max_size=500 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        # the size is only counted again, if it exceeds max_size
+        self._size = self._get_size()
+
+    def get_key(self, method, url, data=None):
+        """ Returns the key of a request """
+        digest = hashlib.sha1('%s %s\n' % (method.upper(), url))
+        if data:
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _get_paths(self, key):
+        path = os.path.join(self.path, key)
+        return path + '.xml', path + '.json'
+
+    def get(self, key):
+        """ Returns the CacheEntry of the key or None """
+        content_path, meta_path = self._get_paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            # the access time is the modification time, see evict
+            os.utime(content_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return CacheEntry(content_path, meta)
+
+    def refresh(self, key):
+        """ Marks the response of the key as revalidated """
+        entry = self.get(key)
+        if entry is not None:
+            entry.meta['stored'] = time.time()
+            self._write(self._get_paths(key)[1], json.dumps(entry.meta))
+
+    def put(self, key, response):
+        """ Stores the requests.Response with the key """
+        content_path, meta_path = self._get_paths(key)
+        meta = {
+            'url': response.url,
+            'stored': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        self._write(content_path, response.content)
+        self._write(meta_path, json.dumps(meta))
+        with self._lock:
+            self._size += len(response.content)
+            if self._size > self.max_size:
+                self._size = self.evict()
+
+    def _write(self, path, content):
+        # write to a temporary file first, so readers (also of other
+        # processes) never see a partial response
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+
+    def _get_entries(self):
+        """ Returns (mtime, size, content path) of all cached responses """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.xml'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _get_size(self):
+        return sum(size for _, size, _ in self._get_entries())
+
+    def evict(self):
+        """
+        Removes the least recently used responses until the cache is
+        smaller than max_size, returns the size of the cache
+        """
+        entries = sorted(self._get_entries())
+        size = sum(size for _, size, _ in entries)
+        for mtime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            for entry_path in (path, path[:-len('.xml')] + '.json'):
+                try:
+                    os.remove(entry_path)
+                except OSError:
+                    pass
+            size -= entry_size
+            log.debug('Removed %s from the CSW response cache', path)
+        return size
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path, ttl=86400, max_size=500 * 1024 * 1024):
+    """
+    Returns the ResponseCache of the directory, it is only created (and
+    its size counted) once per process. The ttl and max_size of the first
+    call for a directory are used.
+    """
+    path = os.path.abspath(path)
+    with _caches_lock:
+        try:
+            return _caches[path]
+        except KeyError:
+            cache = ResponseCache(path, ttl, max_size)
+            _caches[path] = cache
+            return cache
@@ -1,8 +1,11 @@
+import os
 import sys
 from pprint import pprint
 import ckan.lib.cli
 import ckanext.geocat.metadata as md
 import ckanext.geocat.xml_loader as loader
+import ckanext.geocat.values as values
+from ckanext.geocat.cache import get_cache
 
 
 class GeocatCommand(ckan.lib.cli.CkanCommand):
@@ -15,6 +18,8 @@ class GeocatCommand(ckan.lib.cli.CkanCommand):
             paster geocat cql "csw:AnyText like '%birds%'"
             paster geocat list "keyword = 'opendata.swiss'" https://www.geocat.ch/geonetwork/srv/eng/csw-ZH/
             paster geocat dataset "8ae7eeb1-04d4-4c78-93e1-4225412db6a4" https://www.geocat.ch/geonetwork/srv/eng/csw-ZH/
+            paster geocat extract getrecords_page_1.xml getrecords_page_2.xml
+            paster geocat profile profile.json getrecords_page_1.xml getrecords_page_2.xml
 
     '''  # noqa
     summary = __doc__.split('\n')[0]
@@ -28,6 +33,8 @@ class GeocatCommand(ckan.lib.cli.CkanCommand):
             'cql': self.cqlCmd,
             'dataset': self.datasetCmd,
             'list': self.listCmd,
+            'extract': self.extractCmd,
+            'profile': self.profileCmd,
             'help': self.helpCmd,
         }
 
@@ -40,6 +47,16 @@ class GeocatCommand(ckan.lib.cli.CkanCommand):
     def helpCmd(self):
         print self.__doc__
 
+    def _get_csw(self, csw_url):
+        # the responses are cached in the directory GEOCAT_CACHE_DIR
+        cache = None
+        if os.environ.get('GEOCAT_CACHE_DIR'):
+            cache = get_cache(
+                os.environ['GEOCAT_CACHE_DIR'],
+                ttl=int(os.environ.get('GEOCAT_CACHE_TTL', 86400))
+            )
+        return md.CswHelper(url=csw_url.rstrip('/'), cache=cache)
+
     def cqlCmd(self, query=None, csw_url=None):
         if (query is None):
             print "Argument 'query' must be set"
@@ -47,7 +64,7 @@ class GeocatCommand(ckan.lib.cli.CkanCommand):
             sys.exit(1)
         if csw_url is None:
             csw_url = self.DEFAULT_CSW_SERVER
-        csw = md.CswHelper(url=csw_url.rstrip('/'))
+        csw = self._get_csw(csw_url)
         for xml, value in csw.get_by_search(cql=query):
             print xml
 
@@ -57,7 +74,7 @@ class GeocatCommand(ckan.lib.cli.CkanCommand):
         if csw_url is None:
             csw_url = self.DEFAULT_CSW_SERVER
 
-        csw = md.CswHelper(url=csw_url.rstrip('/'))
+        csw = self._get_csw(csw_url)
 
         print "CQL query: %s" % cql
         for record_id in csw.get_id_by_search(cql=cql):
@@ -71,23 +88,24 @@ class GeocatCommand(ckan.lib.cli.CkanCommand):
         if csw_url is None:
             csw_url = self.DEFAULT_CSW_SERVER
 
-        csw = md.CswHelper(url=csw_url.rstrip('/'))
+        csw = self._get_csw(csw_url)
         print "ID: %s" % id
         print ""
 
         xml = csw.get_by_id(id)
         print "XML: %s" % xml
         xml_elem = loader.from_string(xml)
+        context = md.ExtractionContext(xml_elem)
         dataset_metadata = md.GeocatDcatDatasetMetadata()
         dist_metadata = md.GeocatDcatDistributionMetadata()
 
         print ""
         print "Dataset:"
-        pprint(dataset_metadata.get_metadata(xml_elem))
+        pprint(dataset_metadata.get_metadata(context))
 
         print ""
         print "Distributions:"
-        pprint(dist_metadata.get_metadata(xml_elem))
+        pprint(dist_metadata.get_metadata(context))
 
     def searchCmd(self, query=None, csw_url=None):
         if (query is None):
@@ -96,6 +114,48 @@ class GeocatCommand(ckan.lib.cli.CkanCommand):
             sys.exit(1)
         if csw_url is None:
             csw_url = self.DEFAULT_CSW_SERVER
-        csw = md.CswHelper(url=csw_url.rstrip('/'))
+        csw = self._get_csw(csw_url)
         for xml, value in csw.get_by_search(query):
             print xml
+
+    def extractCmd(self, *paths):
+        if not paths:
+            print "At least one file must be given"
+            self.helpCmd()
+            sys.exit(1)
+
+        for path in paths:
+            with open(path) as f:
+                results = md.extract_many(f.read())
+
+            print "File: %s (%d records)" % (path, len(results))
+            for dataset, distributions in results:
+                print ""
+                print "Dataset:"
+                pprint(dataset)
+
+                print ""
+                print "Distributions:"
+                pprint(distributions)
+
+    def profileCmd(self, output=None, *paths):
+        if output is None or not paths:
+            print "Arguments 'output' and at least one file must be set"
+            self.helpCmd()
+            sys.exit(1)
+
+        values.start_profiling()
+        try:
+            count = 0
+            for path in paths:
+                with open(path) as f:
+                    count += len(md.extract_many(f.read()))
+        finally:
+            profile = values.stop_profiling()
+
+        print "Records: %d" % count
+        print ""
+        print profile.report()
+        profile.dump(output)
+        print ""
+        print "Profile written to %s" % output
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 from urlparse import urljoin
+from lxml import etree
 from ckan.lib.helpers import json
-from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+from ckanext.harvest.model import HarvestJob, HarvestObject, \
+    HarvestObjectExtra, HarvestGatherError
 from ckanext.harvest.harvesters import HarvesterBase
 import ckanext.geocat.metadata as md
 import ckanext.geocat.xml_loader as loader
+from ckanext.geocat.cache import get_cache
 from ckan.logic import get_action, NotFound
 from ckan.logic.schema import default_update_package_schema,\
     default_create_package_schema
@@ -15,11 +21,34 @@ from ckan.lib.navl.validators import ignore
 import ckan.plugins.toolkit as tk
 from ckan import model
 from ckan.model import Session
+from ckan.model.system_info import get_system_info, set_system_info
+from sqlalchemy import and_
 import uuid
 
 import logging
 log = logging.getLogger(__name__)
 
+# the fields of the mapped packages and resources, a field missing in a
+# new package is compared as empty value, see _is_equal_package
+PACKAGE_FIELDS = (
+    'accrual_periodicity', 'contact_points', 'coverage', 'description',
+    'groups', 'id', 'identifier', 'issued', 'keywords', 'language',
+    'modified', 'name', 'owner_org', 'publishers', 'relations',
+    'see_alsos', 'spatial', 'temporals', 'title', 'url',
+)
+RESOURCE_FIELDS = (
+    'byte_size', 'coverage', 'description', 'download_url', 'format',
+    'identifier', 'issued', 'language', 'license', 'media_type',
+    'modified', 'rights', 'title', 'url',
+)
+# fields of the package, whose lists are compared regardless of their
+# order, see _get_unordered_value
+UNORDERED_PACKAGE_FIELDS = ('groups', 'keywords', 'relations')
+
+# key prefix of the id of the last full harvest job of a source in the
+# system_info table
+LAST_FULL_HARVEST_KEY = 'ckanext.geocat.last_full_harvest.'
+
 
 class GeocatHarvester(HarvesterBase):
     '''
@@ -28,6 +57,34 @@ class GeocatHarvester(HarvesterBase):
 
     HARVEST_USER = 'harvest'
 
+    # state of the current job and the states of the last jobs by job id,
+    # see _load_job_state
+    _job_state = None
+    _job_states = None
+    JOB_STATE_CACHE_SIZE = 4
+    # the identifier is returned as extras_identifier, if it is not a
+    # field of the search index
+    PACKAGE_INDEX_FIELDS = ['id', 'name', 'identifier', 'extras_identifier']
+
+    # defaults of the harvester config options (see README)
+    DEFAULT_CONFIG = {
+        'delete_missing_datasets': False,
+        'csw_timeout': 60,
+        'csw_pool_size': 10,
+        'fetch_in_gather': False,
+        'fetch_batch_size': 1,
+        'page_size': 50,
+        'gather_workers': 4,
+        'extraction_engine': 'xpath',
+        'incremental': False,
+        'full_harvest_interval': 7,
+        'skip_unchanged': False,
+        'skip_unchanged_content': False,
+        'cache_dir': None,
+        'cache_ttl': 3600,
+        'cache_size': 500,
+    }
+
     def info(self):
         return {
             'name': 'geocat_harvester',
@@ -47,8 +104,8 @@ class GeocatHarvester(HarvesterBase):
         if 'user' not in self.config:
             self.config['user'] = self.HARVEST_USER
 
-        if 'delete_missing_datasets' not in self.config:
-            self.config['delete_missing_datasets'] = False
+        for key, value in self.DEFAULT_CONFIG.iteritems():
+            self.config.setdefault(key, value)
 
         # get config for geocat permalink
         self.config['permalink_url'] = tk.config.get('ckanext.geocat.permalink_url', None) # noqa
@@ -58,27 +115,17 @@ class GeocatHarvester(HarvesterBase):
 
         log.debug('Using config: %r' % self.config)
 
-    def _find_existing_package(self, package_dict):
-        package_show_context = {'model': model, 'session': Session,
-                                'ignore_auth': True}
-
-        user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
-        package_show_context.update({'user': user['name']})
-
-        param = 'identifier:%s' % package_dict['identifier']
-        result = tk.get_action('package_search')(package_show_context,
-                                                 {'fq': param})
-        try:
-            return result['results'][0]
-        except (KeyError, IndexError, TypeError):
-            raise NotFound
-
-    def gather_stage(self, harvest_job):
-        log.debug('In GeocatHarvester gather_stage')
-
-        try:
+    def _load_job_state(self, harvest_job):
+        """
+        Sets the config of the source of the job and returns the
+        HarvestJobState of the job. The states of the last jobs are kept,
+        they are only computed again, if the config of the source changed.
+        """
+        if self._job_states is None:
+            self._job_states = OrderedDict()
+        state = self._job_states.pop(harvest_job.id, None)
+        if state is None or state.source_config != harvest_job.source.config:
             self._set_config(harvest_job.source.config)
-
             if 'organization' not in self.config:
                 context = {
                     'model': model,
@@ -89,6 +136,100 @@ class GeocatHarvester(HarvesterBase):
                     context, {'id': harvest_job.source_id})
                 self.config['organization'] = source_dataset.get(
                     'organization').get('name')
+            state = HarvestJobState(harvest_job.source.config, self.config)
+
+        # the most recently used state is the last one
+        self._job_states[harvest_job.id] = state
+        while len(self._job_states) > self.JOB_STATE_CACHE_SIZE:
+            self._job_states.popitem(last=False)
+        self.config = state.config
+        self._job_state = state
+        return state
+
+    def _find_existing_package(self, package_dict, harvest_job):
+        """
+        Returns the id and name of the package with the identifier of the
+        package_dict, raises NotFound if there is none. An identifier
+        missing in the package index (e.g. a package of another source or
+        created by another process during the job) is searched.
+        """
+        identifier = package_dict['identifier']
+        index = self._get_package_index(harvest_job)
+        if identifier not in index:
+            self._search_identifiers(index, [identifier])
+        try:
+            return index[identifier]
+        except KeyError:
+            raise NotFound
+
+    def _get_package_index(self, harvest_job):
+        """
+        Returns the index identifier -> {'id', 'name'} of the packages of
+        the source and its organization. It is built once per job (and
+        process) and kept up to date with the packages created or deleted
+        by this process.
+        """
+        state = self._load_job_state(harvest_job)
+        if state.package_index is None:
+            state.package_index = self._build_package_index(harvest_job)
+        return state.package_index
+
+    def _build_package_index(self, harvest_job):
+        context = self._create_new_context()
+        search_params = {
+            'fq': '+(harvest_source_id:"{0}" OR organization:"{1}")'.format(
+                harvest_job.source_id,
+                self.config['organization']
+            ),
+            'fl': self.PACKAGE_INDEX_FIELDS,
+            'sort': 'id asc',
+            'rows': 1000,
+            'start': 0,
+        }
+        index = {}
+        while True:
+            result = get_action('package_search')(
+                context.copy(), search_params
+            )
+            _index_packages(index, result['results'])
+            search_params['start'] += search_params['rows']
+            if search_params['start'] >= result['count']:
+                break
+        log.info('Indexed %d packages for source %s',
+                 len(index), harvest_job.source_id)
+        return index
+
+    def _get_existing_identifiers(self, identifiers, harvest_job):
+        """
+        Returns the set of the identifiers with an existing package. The
+        identifiers missing in the package index (e.g. packages created
+        by another process during the job) are searched with one query.
+        """
+        index = self._get_package_index(harvest_job)
+        missing = sorted(set(identifiers) - set(index))
+        if missing:
+            self._search_identifiers(index, missing)
+        return set(identifiers) & set(index)
+
+    def _search_identifiers(self, index, identifiers):
+        """ Adds the packages with one of the identifiers to the index """
+        result = get_action('package_search')(
+            self._create_new_context(),
+            {
+                'fq': '+identifier:(%s)' % ' OR '.join(
+                    '"%s"' % identifier for identifier in identifiers
+                ),
+                'fl': self.PACKAGE_INDEX_FIELDS,
+                'rows': len(identifiers),
+            }
+        )
+        _index_packages(index, result['results'])
+
+    def gather_stage(self, harvest_job):
+        log.debug('In GeocatHarvester gather_stage')
+
+        try:
+            self._load_job_state(harvest_job)
         except GeocatConfigError, e:
             self._save_gather_error(
                 'Config value missing: %s' % str(e),
@@ -102,24 +243,32 @@ class GeocatHarvester(HarvesterBase):
 
         try:
             csw_url = harvest_job.source.url.rstrip('/')
-            csw = md.CswHelper(url=csw_url)
+            csw = self._get_csw(csw_url)
 
             cql = self.config.get('cql', None)
             if cql is None:
                 cql = "keyword = 'opendata.swiss'"
+            harvest_mode, cql = self._get_harvest_mode(harvest_job, cql)
 
             log.debug("CQL query: %s" % cql)
-            for record_id in csw.get_id_by_search(cql=cql):
-                harvest_obj = HarvestObject(
-                    guid=record_id,
-                    job=harvest_job
-                )
-                harvest_obj.save()
-                harvest_obj_ids.append(harvest_obj.id)
+            datestamps = self._get_current_datestamps(harvest_job)
+            records = self._search_records(csw, cql, harvest_mode)
+            for record_id, datestamp, content in records:
+                # unchanged records are neither deleted nor harvested again
                 gathered_dataset_identifiers.append('%s@%s' % (
                     record_id,
                     self.config['organization']
                 ))
+                if datestamp and datestamps.get(record_id) == datestamp:
+                    continue
+
+                harvest_obj = self._create_harvest_object(
+                    harvest_job,
+                    record_id,
+                    content,
+                    datestamp=datestamp
+                )
+                harvest_obj_ids.append(harvest_obj.id)
 
             log.debug('IDs: %r' % harvest_obj_ids)
         except Exception, e:
@@ -130,18 +279,165 @@ class GeocatHarvester(HarvesterBase):
             )
             return []
 
-        if self.config['delete_missing_datasets']:
-            delete_ids = self._check_for_deleted_datasets(
+        if harvest_mode == 'full':
+            harvest_obj_ids.extend(self._finish_full_harvest(
                 harvest_job, gathered_dataset_identifiers
-            )
-            log.debug('delete_ids: %r' % delete_ids)
-            harvest_obj_ids.extend(delete_ids)
+            ))
 
         return harvest_obj_ids
 
+    def _finish_full_harvest(self, harvest_job, gathered_dataset_identifiers):
+        """
+        Records the job as the last full harvest of its source and returns
+        the ids of the delete objects of the datasets, which were not
+        gathered. Only a full harvest knows all datasets of the source.
+        """
+        if self.config['incremental']:
+            set_system_info(
+                LAST_FULL_HARVEST_KEY + harvest_job.source_id,
+                harvest_job.id
+            )
+        if not self.config['delete_missing_datasets']:
+            return []
+        delete_ids = self._check_for_deleted_datasets(
+            harvest_job, gathered_dataset_identifiers
+        )
+        log.debug('delete_ids: %r' % delete_ids)
+        return delete_ids
+
+    def _get_harvest_mode(self, harvest_job, cql):
+        """
+        Returns the harvest mode ('full' or 'incremental') of the job and
+        the CQL query to use. An incremental harvest only gathers the
+        records modified since the day of the last successful job (see
+        _get_finished_jobs). A full harvest is run if incremental
+        harvesting is disabled, if there is no successful job or if the
+        last full harvest failed or is older than 'full_harvest_interval'
+        days.
+        """
+        if not self.config['incremental']:
+            return 'full', cql
+
+        last_job = self._get_finished_jobs(harvest_job) \
+            .order_by(HarvestJob.gather_started.desc()) \
+            .first()
+        last_full_job = None
+        last_full_job_id = get_system_info(
+            LAST_FULL_HARVEST_KEY + harvest_job.source_id
+        )
+        if last_full_job_id is not None:
+            last_full_job = self._get_finished_jobs(harvest_job) \
+                .filter(HarvestJob.id == last_full_job_id) \
+                .first()
+        interval = timedelta(days=self.config['full_harvest_interval'])
+        if (last_job is None or last_full_job is None or
+                last_full_job.gather_started < datetime.utcnow() - interval):
+            log.info('Running a full harvest of source %s',
+                     harvest_job.source_id)
+            return 'full', cql
+
+        since = last_job.gather_started.date().isoformat()
+        log.info('Running an incremental harvest of source %s since %s',
+                 harvest_job.source_id, since)
+        return 'incremental', _incremental_cql(cql, since)
+
+    def _get_finished_jobs(self, harvest_job):
+        """
+        Returns the query of the other finished jobs of the source of the
+        harvest job without gather errors. Object errors of single
+        records do not count, these records are harvested again by the
+        next full harvest.
+        """
+        gather_errors = Session.query(HarvestGatherError.harvest_job_id)
+        return Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == harvest_job.source_id) \
+            .filter(HarvestJob.id != harvest_job.id) \
+            .filter(HarvestJob.status == 'Finished') \
+            .filter(~HarvestJob.id.in_(gather_errors.subquery()))
+
+    def _get_csw(self, csw_url):
+        """
+        Returns a CswHelper for the url, its requests use the pooled
+        connections of the process (see md.get_session)
+        """
+        cache = None
+        if self.config['cache_dir']:
+            cache = get_cache(
+                self.config['cache_dir'],
+                ttl=self.config['cache_ttl'],
+                max_size=self.config['cache_size'] * 1024 * 1024
+            )
+        return md.CswHelper(
+            url=csw_url,
+            page_size=self.config['page_size'],
+            workers=self.config['gather_workers'],
+            timeout=self.config['csw_timeout'],
+            pool_size=self.config['csw_pool_size'],
+            cache=cache
+        )
+
+    def _search_records(self, csw, cql, harvest_mode='full'):
+        """
+        Yields (id, datestamp, content) of the found records. The content
+        is only requested in the gather stage if 'fetch_in_gather' is set,
+        otherwise it is None and the record is requested in fetch_stage.
+        The datestamp is only requested with 'skip_unchanged' or
+        'fetch_in_gather'.
+        """
+        if self.config['fetch_in_gather']:
+            esn = 'full'
+        elif self.config['skip_unchanged']:
+            esn = 'summary'
+        else:
+            esn = 'brief'
+        try:
+            for record in csw.get_records_by_search(cql=cql, esn=esn):
+                yield record
+        except md.DatasetNotFoundError:
+            # no record has been modified since the last harvest
+            if harvest_mode != 'incremental':
+                raise
+            log.info('No records modified, CQL query: %s', cql)
+
+    def _create_harvest_object(self, harvest_job, record_id, content,
+                               **extras):
+        """ Creates the harvest object of a record, skips empty extras """
+        harvest_obj = HarvestObject(
+            guid=record_id,
+            job=harvest_job,
+            content=content,
+            extras=[
+                HarvestObjectExtra(key=key, value=value)
+                for key, value in sorted(extras.iteritems()) if value
+            ]
+        )
+        harvest_obj.save()
+        return harvest_obj
+
+    def _get_current_datestamps(self, harvest_job):
+        """
+        Returns the datestamps of the records of the current harvest
+        objects of the source by guid, if 'skip_unchanged' is set. Records
+        whose package has been deleted are left out, so they are imported
+        again.
+        """
+        if not self.config['skip_unchanged']:
+            return {}
+        query = Session.query(HarvestObject.guid, HarvestObjectExtra.value) \
+            .join(HarvestObjectExtra,
+                  HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+            .join(model.Package,
+                  model.Package.id == HarvestObject.package_id) \
+            .filter(model.Package.state == model.State.ACTIVE) \
+            .filter(HarvestObject.harvest_source_id ==
+                    harvest_job.source_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObjectExtra.key == 'datestamp') \
+            .order_by(HarvestObject.gathered)  # noqa
+        return dict(query)
+
     def fetch_stage(self, harvest_object):
         log.debug('In GeocatHarvester fetch_stage')
-        self._set_config(harvest_object.job.source.config)
 
         if not harvest_object:
             log.error('No harvest object received')
@@ -151,13 +447,26 @@ class GeocatHarvester(HarvesterBase):
             )
             return False
 
+        if harvest_object.content:
+            log.debug('content of %s already fetched', harvest_object.guid)
+            return True
+
         csw_url = harvest_object.source.url.rstrip('/')
         csw = None
         try:
-            csw = md.CswHelper(url=csw_url)
-            xml = csw.get_by_id(harvest_object.guid)
-            harvest_object.content = xml
-            harvest_object.save()
+            self._load_job_state(harvest_object.job)
+            csw = self._get_csw(csw_url)
+            import_action = self._get_object_extra(
+                harvest_object,
+                'import_action'
+            )
+            if (self.config['fetch_batch_size'] > 1 and
+                    import_action != 'delete'):
+                self._fetch_batch(csw, harvest_object)
+            else:
+                xml = csw.get_by_id(harvest_object.guid)
+                harvest_object.content = xml
+                harvest_object.save()
             log.debug('successfully processed ' + harvest_object.guid)
             return True
         except Exception, e:
@@ -179,9 +488,50 @@ class GeocatHarvester(HarvesterBase):
             )
             return False
 
+    def _fetch_batch(self, csw, harvest_object):
+        """
+        Fetches the content of the harvest object together with other
+        pending objects of the job with one request. The fetch_stage of
+        the other objects then finds their content and returns early.
+        """
+        batch = [harvest_object] + self._get_pending_objects(
+            harvest_object,
+            self.config['fetch_batch_size'] - 1
+        )
+        objects = dict((obj.guid, obj) for obj in batch)
+        for xml, record_id in csw.get_by_ids(
+                objects.keys(), chunk_size=self.config['fetch_batch_size']):
+            if record_id in objects:
+                objects[record_id].content = xml
+                objects[record_id].save()
+
+        if not harvest_object.content:
+            raise md.DatasetNotFoundError(
+                "No dataset for the id '%s' found" % harvest_object.guid
+            )
+
+    def _get_pending_objects(self, harvest_object, limit):
+        """
+        Returns up to limit other objects of the job that are waiting to
+        be fetched and have no content yet, objects to be deleted are not
+        fetched from the CSW.
+        """
+        is_delete = HarvestObject.extras.any(and_(
+            HarvestObjectExtra.key == 'import_action',
+            HarvestObjectExtra.value == 'delete'
+        ))
+        return Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id ==
+                    harvest_object.harvest_job_id) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObject.state == 'WAITING') \
+            .filter(HarvestObject.content.is_(None)) \
+            .filter(~is_delete) \
+            .limit(limit) \
+            .all()
+
     def import_stage(self, harvest_object):  # noqa
         log.debug('In GeocatHarvester import_stage')
-        self._set_config(harvest_object.job.source.config)
 
         if not harvest_object:
             log.error('No harvest object received')
@@ -191,31 +541,36 @@ class GeocatHarvester(HarvesterBase):
             )
             return False
 
-        # check if dataset must be deleted
-        import_action = self._get_object_extra(harvest_object, 'import_action')
-        if import_action and import_action == 'delete':
-            log.debug('import action: %s' % import_action)
-            harvest_object.current = False
-            return self._delete_dataset({'id': harvest_object.guid})
-
         try:
-            if 'organization' not in self.config:
-                context = {
-                    'model': model,
-                    'session': Session,
-                    'ignore_auth': True
-                }
-                source_dataset = get_action('package_show')(
-                    context, {'id': harvest_object.source.id})
-                self.config['organization'] = source_dataset.get(
-                    'organization').get('name')
+            state = self._load_job_state(harvest_object.job)
+
+            # check if dataset must be deleted
+            import_action = self._get_object_extra(
+                harvest_object,
+                'import_action'
+            )
+            if import_action and import_action == 'delete':
+                log.debug('import action: %s' % import_action)
+                harvest_object.current = False
+                return self._delete_dataset({'id': harvest_object.guid})
 
             xml_elem = loader.from_string(harvest_object.content)
-            dataset_metadata = md.GeocatDcatDatasetMetadata()
+            content_hash = self._get_content_hash(xml_elem)
+            harvest_object.extras.append(HarvestObjectExtra(
+                key='content_hash',
+                value=content_hash
+            ))
+            if self._is_unchanged_content(harvest_object, content_hash):
+                return 'unchanged'
+
+            context = md.ExtractionContext(xml_elem)
+            dataset_metadata = md.GeocatDcatDatasetMetadata(
+                engine=self.config['extraction_engine']
+            )
             dist_metadata = md.GeocatDcatDistributionMetadata()
 
-            pkg_dict = dataset_metadata.get_metadata(xml_elem)
-            dist_list = dist_metadata.get_metadata(xml_elem)
+            pkg_dict = dataset_metadata.get_metadata(context)
+            dist_list = dist_metadata.get_metadata(context)
 
             for dist in dist_list:
                 if not dist.get('rights'):
@@ -233,18 +588,18 @@ class GeocatHarvester(HarvesterBase):
 
             # geocat returns see_alsos as UUID, check if there are
             # datasets from the same organization as the harvester
-            existing_see_alsos = []
-            for linked_uuid in pkg_dict['see_alsos']:
-                try:
-                    identifier = '%s@%s' % (
-                        linked_uuid,
-                        self.config['organization']
-                    )
-                    check_dict = {'identifier': identifier}
-                    self._find_existing_package(check_dict)
-                    existing_see_alsos.append({'dataset_identifier': identifier})  # noqa
-                except NotFound:
-                    continue
+            see_also_identifiers = [
+                '%s@%s' % (linked_uuid, self.config['organization'])
+                for linked_uuid in pkg_dict['see_alsos']
+            ]
+            existing_identifiers = self._get_existing_identifiers(
+                see_also_identifiers, harvest_object.job
+            )
+            existing_see_alsos = [
+                {'dataset_identifier': identifier}
+                for identifier in see_also_identifiers
+                if identifier in existing_identifiers
+            ]
             pkg_dict['see_alsos'] = existing_see_alsos
 
             pkg_dict['owner_org'] = self.config['organization']
@@ -274,19 +629,29 @@ class GeocatHarvester(HarvesterBase):
                 'user': self.config['user'],
             }
             try:
-                # Change default schema to ignore lists of dicts, which
-                # are stored in the '__junk' field
-                schema = default_update_package_schema()
-                schema['__junk'] = [ignore]
+                package_context['schema'] = state.update_schema
 
-                package_context['schema'] = schema
-
-                existing = self._find_existing_package(pkg_dict)
+                existing = self._find_existing_package(
+                    pkg_dict, harvest_object.job
+                )
                 log.debug(
                     "Existing package found, updating %s..." % existing['id']
                 )
                 pkg_dict['name'] = existing['name']
                 pkg_dict['id'] = existing['id']
+                stored = get_action('package_show')(
+                    self._create_new_context(), {'id': existing['id']}
+                )
+                if _is_equal_package(pkg_dict, stored):
+                    log.debug('Package %s unchanged, skipping the update',
+                              existing['id'])
+                    self._replace_current_object(
+                        harvest_object,
+                        self._get_current_object(harvest_object),
+                        existing['id']
+                    )
+                    return 'unchanged'
+                _match_resources(pkg_dict['resources'], stored['resources'])
                 updated_pkg = get_action('package_update')(
                     package_context, pkg_dict)
                 harvest_object.current = True
@@ -294,12 +659,7 @@ class GeocatHarvester(HarvesterBase):
                 harvest_object.save()
                 log.debug("Updated PKG: %s" % updated_pkg)
             except NotFound:
-                # Change default schema to ignore lists of dicts, which
-                # are stored in the '__junk' field
-                schema = default_create_package_schema()
-                schema['__junk'] = [ignore]
-
-                package_context['schema'] = schema
+                package_context['schema'] = state.create_schema
 
                 log.debug("No package found, create a new one!")
 
@@ -321,6 +681,9 @@ class GeocatHarvester(HarvesterBase):
                     package_context, pkg_dict)
 
                 log.debug("Created PKG: %s" % created_pkg)
+                self._get_package_index(harvest_object.job)[
+                    pkg_dict['identifier']
+                ] = {'id': created_pkg['id'], 'name': created_pkg['name']}
 
             Session.commit()
             return True
@@ -335,14 +698,80 @@ class GeocatHarvester(HarvesterBase):
             )
             return False
 
+    def _get_content_hash(self, xml_elem):
+        """
+        Returns the digest of the canonical XML of the record and of the
+        harvester config, which both determine the imported package
+        """
+        digest = hashlib.sha1(
+            etree.tostring(xml_elem.getroottree(), method='c14n')
+        )
+        digest.update(json.dumps(self.config, sort_keys=True))
+        return digest.hexdigest()
+
+    def _is_unchanged_content(self, harvest_object, content_hash):
+        """
+        If 'skip_unchanged_content' is set and the content hash equals the
+        one of the current harvest object of the guid, the harvest object
+        takes its place and is linked to the existing package. If the
+        package has been deleted in the meantime, the record is imported.
+        """
+        if not self.config['skip_unchanged_content']:
+            return False
+
+        previous = self._get_current_object(harvest_object)
+        if (previous is None or previous.package_id is None or
+                self._get_object_extra(previous, 'content_hash') !=
+                content_hash):
+            return False
+
+        package = model.Package.get(previous.package_id)
+        if package is None or package.state != model.State.ACTIVE:
+            log.debug('Package of %s has been deleted, importing it again',
+                      harvest_object.guid)
+            return False
+
+        log.debug('Content of %s unchanged, skipping the import',
+                  harvest_object.guid)
+        self._replace_current_object(
+            harvest_object, previous, previous.package_id
+        )
+        return True
+
+    def _replace_current_object(self, harvest_object, previous, package_id):
+        """
+        Makes the harvest object the current one of its guid instead of
+        the previous one and links it to the package, if its import is
+        skipped
+        """
+        if previous is not None:
+            previous.current = False
+            previous.save()
+        harvest_object.current = True
+        harvest_object.package_id = package_id
+        harvest_object.save()
+
+    def _get_current_object(self, harvest_object):
+        """ Returns the last current harvest object of the guid """
+        return Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_source_id ==
+                    harvest_object.harvest_source_id) \
+            .filter(HarvestObject.guid == harvest_object.guid) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObject.current == True) \
+            .order_by(HarvestObject.gathered.desc()) \
+            .first()  # noqa
+
     def _create_new_context(self):
-        # get the site user
-        site_user = tk.get_action('get_site_user')(
-            {'model': model, 'ignore_auth': True}, {})
+        # the site user is only requested once per job
+        state = self._job_state
+        if state.site_user is None:
+            state.site_user = tk.get_action('get_site_user')(
+                {'model': model, 'ignore_auth': True}, {})['name']
         context = {
             'model': model,
             'session': Session,
-            'user': site_user['name'],
+            'user': state.site_user,
         }
         return context
 
@@ -376,12 +805,15 @@ class GeocatHarvester(HarvesterBase):
                  (len(existing_package_names), harvest_job.source_id))
         return existing_package_names
 
-    def _get_package_names_from_identifiers(self, package_identifiers):
+    def _get_package_names_from_identifiers(self, harvest_job,
+                                            package_identifiers):
         package_names = []
         for identifier in package_identifiers:
             pkg = {'identifier': identifier}
             try:
-                existing_package = self._find_existing_package(pkg)
+                existing_package = self._find_existing_package(
+                    pkg, harvest_job
+                )
                 package_names.append(existing_package['name'])
             except NotFound:
                 continue
@@ -394,7 +826,7 @@ class GeocatHarvester(HarvesterBase):
             harvest_job
         )
         gathered_existing_package_names = self._get_package_names_from_identifiers(  # noqa
-            gathered_dataset_identifiers
+            harvest_job, gathered_dataset_identifiers
         )
         delete_names = list(set(existing_package_names) -
                             set(gathered_existing_package_names))
@@ -428,6 +860,12 @@ class GeocatHarvester(HarvesterBase):
             context.copy(),
             package_dict
         )
+        index = self._job_state.package_index
+        if index:
+            # the id of a delete object is the name of the package
+            for identifier, pkg in index.items():
+                if package_dict['id'] in (pkg['id'], pkg['name']):
+                    del index[identifier]
         return True
 
     def _get_object_extra(self, harvest_object, key):
@@ -455,6 +893,28 @@ class GeocatHarvester(HarvesterBase):
                 'label': self.config['permalink_title']}
 
 
+class HarvestJobState(object):
+    """
+    The state of the harvester, which only depends on a job and the config
+    of its source, see GeocatHarvester._load_job_state
+    """
+
+    def __init__(self, source_config, config):
+        self.source_config = source_config
+        # the parsed config of the source
+        self.config = config
+        # the default schemas, changed to ignore lists of dicts, which
+        # are stored in the '__junk' field
+        self.update_schema = default_update_package_schema()
+        self.update_schema['__junk'] = [ignore]
+        self.create_schema = default_create_package_schema()
+        self.create_schema['__junk'] = [ignore]
+        # the name of the site user, see _create_new_context
+        self.site_user = None
+        # identifier -> {'id', 'name'}, see _get_package_index
+        self.package_index = None
+
+
 class GeocatConfigError(Exception):
     pass
 
@@ -462,3 +922,124 @@ class GeocatConfigError(Exception):
 def _derive_flat_title(title_dict):
     """localizes language dict if no language is specified"""
     return title_dict.get('de') or title_dict.get('fr') or title_dict.get('en') or title_dict.get('it') or ""  # noqa
+
+
+def _is_equal_package(pkg_dict, stored):
+    """
+    Compares a new package dict with the stored package. Only the mapped
+    fields of the package and of its resources are compared, the stored
+    ones also contain ids, timestamps etc.
+    """
+    pkg_dict = dict(pkg_dict)
+    resources = pkg_dict.pop('resources', None) or []
+    stored_resources = stored.get('resources') or []
+    # the new package references its organization by name
+    organization = stored.get('organization') or {}
+    if pkg_dict.get('owner_org') == organization.get('name'):
+        pkg_dict['owner_org'] = stored.get('owner_org')
+
+    return (
+        len(resources) == len(stored_resources) and
+        _is_equal_fields(pkg_dict, stored, PACKAGE_FIELDS) and
+        all(_is_equal_fields(resource, stored_resource, RESOURCE_FIELDS)
+            for resource, stored_resource in zip(resources, stored_resources))
+    )
+
+
+def _match_resources(resources, stored_resources):
+    """
+    Sets the id of the stored resource with the same URL and download URL
+    on the new resources, so package_update changes these resources in
+    place instead of replacing them and their ids stay stable. The
+    download URL is only set for download distributions, so a service
+    and a download of the same URL are different resources.
+    """
+    stored_ids = {}
+    for resource in stored_resources:
+        stored_ids.setdefault(_get_resource_key(resource), []) \
+            .append(resource['id'])
+    for resource in resources:
+        ids = stored_ids.get(_get_resource_key(resource))
+        if ids:
+            resource['id'] = ids.pop(0)
+
+
+def _get_resource_key(resource):
+    return (
+        _to_unicode(resource.get('url') or ''),
+        _to_unicode(resource.get('download_url') or ''),
+    )
+
+
+def _is_equal_fields(new, stored, fields):
+    """
+    Compares the fields and the other keys of the new dict with the
+    stored dict, missing fields are empty
+    """
+    for key in set(fields) | set(new):
+        if key in UNORDERED_PACKAGE_FIELDS:
+            equal = (_get_unordered_value(key, new.get(key)) ==
+                     _get_unordered_value(key, stored.get(key)))
+        else:
+            equal = _is_equal_value(new.get(key), stored.get(key))
+        if not equal:
+            return False
+    return True
+
+
+def _get_unordered_value(key, value):
+    """
+    Returns the comparable value of a field, whose order does not matter:
+    the names of the groups, the keywords of each language and the URLs
+    and labels of the relations as sets
+    """
+    if key == 'groups':
+        return set(_to_unicode(group.get('name'))
+                   for group in value or [])
+    if key == 'keywords':
+        return dict((lang, set(_to_unicode(word) for word in words))
+                    for lang, words in (value or {}).iteritems() if words)
+    return set((_to_unicode(relation.get('url') or ''),
+                _to_unicode(relation.get('label') or ''))
+               for relation in value or [])
+
+
+def _is_equal_value(new, stored):
+    """
+    Compares two values of a package, empty values (None, '', [], {}) are
+    equal and scalars are compared as strings. Dicts are compared on the
+    keys of both, missing keys are empty.
+    """
+    empty = (None, '', [], {})
+    if new in empty or stored in empty:
+        return new in empty and stored in empty
+    if isinstance(new, dict):
+        return (isinstance(stored, dict) and
+                all(_is_equal_value(new.get(key), stored.get(key))
+                    for key in set(new) | set(stored)))
+    if isinstance(new, (list, tuple)):
+        return (isinstance(stored, (list, tuple)) and
+                len(new) == len(stored) and
+                all(_is_equal_value(n, s) for n, s in zip(new, stored)))
+    if isinstance(stored, (dict, list, tuple)):
+        return False
+    return _to_unicode(new) == _to_unicode(stored)
+
+
+def _to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def _index_packages(index, packages):
+    """ Adds the packages of a package_search to the package index """
+    for pkg in packages:
+        identifier = pkg.get('identifier') or pkg.get('extras_identifier')
+        if identifier:
+            index[identifier] = {'id': pkg['id'], 'name': pkg['name']}
+
+
+def _incremental_cql(cql, since):
+    """ Restricts the CQL query to the records modified since the date """
+    return "(%s) AND Modified >= '%s'" % (cql, since)
@@ -1,22 +1,32 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
+from io import BytesIO
+import threading
 import time
 from collections import defaultdict
+from copy import deepcopy
 from urlparse import urlparse
-from owslib.csw import CatalogueServiceWeb
+from multiprocessing.pool import ThreadPool
+from lxml import etree
+import requests
+from owslib.csw import CatalogueServiceWeb, namespaces as csw_namespaces
+from owslib import ows
 from owslib import util
 import owslib.iso as iso
 from ckan.lib.munge import munge_tag
 
 import ckanext.geocat.xml_loader as loader
+import ckanext.geocat.streaming as streaming
+import ckanext.geocat.xslt as xslt
 from ckanext.geocat.values import (
     ArrayValue,
     FirstInOrderValue,
     StringValue,
     XPathValue,
     XPathMultiValue,
-    XPathSubValue
+    XPathSubValue,
+    get_profile
 )
 
 import logging
@@ -68,9 +78,117 @@ def _get_category_mappings_as_set(swisstopo_groups):
     return set(ogdch_categories)
 
 
+protocol_title_mapping = {
+    "OGC:WMTS-http-get-capabilities": "WMTS (GetCapabilities)",
+    "OGC:WMS-http-get-map": "WMS (GetMap)",
+    "OGC:WMS-http-get-capabilities": "WMS (GetCapabilities)",
+    "OGC:WFS-http-get-capabilities": "WFS (GetCapabilities)",
+    "WWW:DOWNLOAD-1.0-http--download": "Download",
+    "WWW:DOWNLOAD-URL": "Download",
+    "OGC:WMS": "WMS (GetMap)",
+    "OGC:WFS": "WFS (GetCapabilities)",
+    "OGC:WMTS": "WMTS (GetCapabilities)",
+    "WWW:DOWNLOAD-FTP": "Download",
+}
+
+rights_mapping = {
+    u'Freie Nutzung': 'NonCommercialAllowed-CommercialAllowed-ReferenceNotRequired',  # noqa
+    u'Utilisation libre': 'NonCommercialAllowed-CommercialAllowed-ReferenceNotRequired',  # noqa
+
+    u'Freie Nutzung. Quellenangabe ist Pflicht.': 'NonCommercialAllowed-CommercialAllowed-ReferenceRequired',  # noqa
+    u'Utilisation libre. Obligation d’indiquer la source.': 'NonCommercialAllowed-CommercialAllowed-ReferenceRequired',  # noqa
+
+    u'Freie Nutzung. Kommerzielle Nutzung nur mit Bewilligung des Datenlieferanten zulässig.': 'NonCommercialAllowed-CommercialWithPermission-ReferenceNotRequired',  # noqa
+    u'Utilisation libre. Utilisation à des fins commerciales uniquement avec l’autorisation du fournisseur des données.': 'NonCommercialAllowed-CommercialWithPermission-ReferenceNotRequired',  # noqa
+
+    u'Freie Nutzung. Quellenangabe ist Pflicht. Kommerzielle Nutzung nur mit Bewilligung des Datenlieferanten zulässig.': 'NonCommercialAllowed-CommercialWithPermission-ReferenceRequired',  # noqa
+    u'Utilisation libre. Obligation d’indiquer la source. Utilisation commerciale uniquement avec l’autorisation du fournisseur des données.': 'NonCommercialAllowed-CommercialWithPermission-ReferenceRequired' # noqa
+}
+
+frequency_mapping = {
+    'continual': 'http://purl.org/cld/freq/continuous',
+    'daily': 'http://purl.org/cld/freq/daily',
+    'weekly': 'http://purl.org/cld/freq/weekly',
+    'fortnightly': 'http://purl.org/cld/freq/biweekly',
+    'monthly': 'http://purl.org/cld/freq/monthly',
+    'quarterly': 'http://purl.org/cld/freq/quarterly',
+    'biannually': 'http://purl.org/cld/freq/semiannual',
+    'annually': 'http://purl.org/cld/freq/annual',
+    'asNeeded': 'http://purl.org/cld/freq/completelyIrregular',
+    'irregular': 'http://purl.org/cld/freq/completelyIrregular',
+}
+
+language_mapping = {
+    'ger': 'de',
+    'fra': 'fr',
+    'eng': 'en',
+    'ita': 'it',
+}
+
+
+class MappingPlan(object):
+    """
+    The execution plan of a mapping.
+
+    Iterating the plan returns the (key, attribute) tuples of the fields,
+    that need to be evaluated for every record. Constant values are only
+    evaluated once, when the plan is built, and fields that are overwritten
+    after the extraction are not evaluated at all.
+    """
+    def __init__(self, mapping, overwritten_fields=(), name=None):
+        # identifies the fields of the plan in a profile
+        self.name = name
+        # (key, attribute, constant) in the order of the mapping, so the
+        # extracted dict is always built the same way
+        steps = []
+        for key, attribute in mapping.iteritems():
+            if key in overwritten_fields:
+                steps.append((key, None, None))
+            elif attribute.is_constant():
+                steps.append((key, None, attribute.get_value()))
+            else:
+                steps.append((key, attribute, None))
+        self.steps = tuple(steps)
+        self.fields = tuple(
+            (key, attribute) for key, attribute, _ in steps if attribute
+        )
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def evaluate(self, **kwargs):
+        """ Returns the values of all keys, kwargs are passed to the values """
+        # one memo per record, identical expressions are only evaluated once
+        kwargs.setdefault('memo', {})
+        profile = get_profile()
+        extracted = {}
+        for key, attribute, constant in self.steps:
+            if attribute is not None and profile is not None:
+                field = '%s.%s' % (self.name, key) if self.name else key
+                start = time.time()
+                extracted[key] = attribute.get_value(field=field, **kwargs)
+                profile.add_field(field, time.time() - start, extracted[key])
+            elif attribute is not None:
+                extracted[key] = attribute.get_value(**kwargs)
+            elif isinstance(constant, list):
+                # the callers may change the lists
+                extracted[key] = _copy_values(constant)
+            else:
+                extracted[key] = constant
+        return extracted
+
+
+# mapping plans per metadata class, see DcatMetadata.get_plan
+_plans = {}
+
+
 class DcatMetadata(object):
     """ Provides general access to dataset metadata for DCAT-AP Switzerland """
 
+    # fields of the mapping that are set after the extraction,
+    # they are not evaluated (see MappingPlan)
+    overwritten_fields = ()
+
     def get_mapping(self):
         """
         Abstract method to define the dict
@@ -78,6 +196,25 @@ class DcatMetadata(object):
         """
         raise NotImplementedError
 
+    def get_plan(self):
+        """
+        Returns the MappingPlan of this class. The plan is only built once
+        per class and process, so loading a record only has to evaluate
+        it. The values keep no state between evaluations, so one plan is
+        shared by all threads.
+        """
+        cls = type(self)
+        try:
+            return _plans[cls]
+        except KeyError:
+            plan = MappingPlan(
+                self.get_mapping(),
+                self.overwritten_fields,
+                cls.__name__
+            )
+            _plans[cls] = plan
+            return plan
+
     def get_metadata(self):
         """
         Abstract method that returns the loaded metadata as a dict
@@ -85,19 +222,27 @@ class DcatMetadata(object):
         """
         raise NotImplementedError
 
-    def load(self, meta_xml, include_raw=False):
+    def load(self, meta_xml, include_raw=False, index=None):
         if isinstance(meta_xml, basestring):
             meta_xml = loader.from_string(meta_xml)
-        mapping = self.get_mapping()
-        dcat_metadata = {}
-        for key, attribute in mapping.items():
-            dcat_metadata[key] = attribute.get_value(
-                xml=meta_xml
-            )
+        dcat_metadata = self.extract(meta_xml, index)
         if include_raw:
             return (self._clean_dataset(dcat_metadata), dcat_metadata)
         return self._clean_dataset(dcat_metadata)
 
+    def extract(self, meta_xml, index=None, results=None):
+        """
+        Returns the raw (uncleaned) values of all mapping fields,
+        `results` are the precomputed results of an engine (see xslt)
+        """
+        if index is None:
+            index = loader.DocumentIndex(meta_xml)
+        return self.get_plan().evaluate(
+            xml=meta_xml,
+            index=index,
+            results=results
+        )
+
     def _clean_dataset(self, dataset):
         cleaned_dataset = defaultdict(dict)
 
@@ -147,7 +292,7 @@ class DcatMetadata(object):
         cleaned_dataset.pop('rights', None)
 
         clean_dict = dict(cleaned_dataset)
-        log.debug("Cleaned dataset: %s" % clean_dict)
+        log.debug("Cleaned dataset: %s", clean_dict)
 
         return clean_dict
 
@@ -244,20 +389,8 @@ class DcatMetadata(object):
     def _clean_accrual_periodicity(self, pkg_dict):
         if 'accrual_periodicity' not in pkg_dict:
             return ''
-        frequency_mapping = {
-            'continual': 'http://purl.org/cld/freq/continuous',
-            'daily': 'http://purl.org/cld/freq/daily',
-            'weekly': 'http://purl.org/cld/freq/weekly',
-            'fortnightly': 'http://purl.org/cld/freq/biweekly',
-            'monthly': 'http://purl.org/cld/freq/monthly',
-            'quarterly': 'http://purl.org/cld/freq/quarterly',
-            'biannually': 'http://purl.org/cld/freq/semiannual',
-            'annually': 'http://purl.org/cld/freq/annual',
-            'asNeeded': 'http://purl.org/cld/freq/completelyIrregular',
-            'irregular': 'http://purl.org/cld/freq/completelyIrregular',
-        }
         log.debug(
-            "Trying to map periodicity '%s'" % pkg_dict['accrual_periodicity']
+            "Trying to map periodicity '%s'", pkg_dict['accrual_periodicity']
         )
         try:
             return frequency_mapping[pkg_dict['accrual_periodicity']]
@@ -265,15 +398,234 @@ class DcatMetadata(object):
             return ''
 
 
+class ExtractionContext(object):
+    """
+    Holds a parsed metadata document and the dataset values extracted
+    from it. The dataset and its distributions are extracted from the
+    same context, so the dataset mapping only runs once per document.
+    """
+    def __init__(self, xml):
+        if isinstance(xml, basestring):
+            xml = loader.from_string(xml)
+        self.xml = xml
+        self.index = loader.DocumentIndex(xml)
+        self.dataset = None
+        self.raw_dataset = None
+
+    def load_dataset(self, dataset_metadata=None):
+        """
+        Returns the cleaned and the raw dataset values as a tuple,
+        the dataset is only extracted on the first call
+        """
+        if self.dataset is None:
+            if dataset_metadata is None:
+                dataset_metadata = GeocatDcatDatasetMetadata()
+            self.dataset, self.raw_dataset = dataset_metadata.load(
+                self.xml,
+                include_raw=True,
+                index=self.index
+            )
+        return self.dataset, self.raw_dataset
+
+
+def _get_context(xml):
+    if isinstance(xml, ExtractionContext):
+        return xml
+    return ExtractionContext(xml)
+
+
+def _copy_values(value):
+    """
+    Copies the dicts and lists of an extracted value, the values
+    themselves (strings) are shared
+    """
+    if isinstance(value, dict):
+        return dict(
+            (key, _copy_values(inner)) for key, inner in value.iteritems()
+        )
+    if isinstance(value, list):
+        return [_copy_values(inner) for inner in value]
+    return value
+
+
+def extract_many(records, engine='xpath'):
+    """
+    Extracts the datasets and distributions of many records at once.
+
+    `records` is either a GetRecords response (as string or element) or a
+    list of CHE_MD_Metadata elements. The metadata instances and their
+    plans are shared by all records, each record gets its own document and
+    index. Returns a list of (dataset, distributions) tuples in the order
+    of the records.
+    """
+    if isinstance(records, basestring):
+        records = loader.from_string(records)
+    if etree.iselement(records):
+        records = loader.xpath(records, '//che:CHE_MD_Metadata')
+
+    dataset_metadata = GeocatDcatDatasetMetadata(engine=engine)
+    dist_metadata = GeocatDcatDistributionMetadata()
+
+    results = []
+    for record in records:
+        # the mapping paths are absolute, so every record
+        # must be the root of its own document
+        if record.getroottree().getroot() is not record:
+            record = deepcopy(record)
+        context = ExtractionContext(record)
+        results.append((
+            dataset_metadata.get_metadata(context),
+            dist_metadata.get_metadata(context)
+        ))
+    return results
+
+
+dataset_mapping = {
+    'identifier': XPathValue('//gmd:fileIdentifier/gco:CharacterString/text()'),  # noqa
+    'title_de': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#DE"]/text()'),  # noqa
+    'title_fr': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#FR"]/text()'),  # noqa
+    'title_it': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#IT"]/text()'),  # noqa
+    'title_en': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#EN"]/text()'),  # noqa
+    'description_de': XPathValue('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#DE"]/text()'),  # noqa
+    'description_fr': XPathValue('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#FR"]/text()'),  # noqa
+    'description_it': XPathValue('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#IT"]/text()'),  # noqa
+    'description_en': XPathValue('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#EN"]/text()'),  # noqa
+    'issued': FirstInOrderValue(
+        [
+            XPathValue('//gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "publication"]//gco:DateTime/text() | //gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "publication"]//gco:Date/text()'),  # noqa
+            XPathValue('//gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "creation"]//gco:DateTime/text() | //gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "creation"]//gco:Date/text()'),  # noqa
+            XPathValue('//gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "revision"]//gco:DateTime/text() | //gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "revision"]//gco:Date/text()'),  # noqa
+        ]
+    ),
+    'modified': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "revision"]//gco:DateTime/text() | //gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "revision"]//gco:Date/text()'),  # noqa
+    'publishers': ArrayValue([
+        FirstInOrderValue(
+            [
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "publisher"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "owner"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "pointOfContact"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "distributor"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "custodian"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:contact//che:CHE_CI_ResponsibleParty//gmd:organisationName/gco:CharacterString'),  # noqa
+            ]
+        )
+    ]),
+    'contact_points': ArrayValue([
+        FirstInOrderValue(
+            [
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "publisher"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "owner"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "pointOfContact"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "distributor"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "custodian"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
+                XPathValue('//gmd:contact//che:CHE_CI_ResponsibleParty//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
+            ]
+        )
+    ]),
+    'groups': XPathMultiValue('//gmd:identificationInfo//gmd:topicCategory/gmd:MD_TopicCategoryCode/text()'),  # noqa
+    'language': FirstInOrderValue(
+        [
+            XPathValue('//gmd:identificationInfo//gmd:language/gco:CharacterString/text()'),  # noqa
+            XPathValue('//che:CHE_MD_Metadata/gmd:language/gco:CharacterString/text()'),  # noqa
+        ]
+    ),
+    'relations': ArrayValue(
+        [
+            XPathSubValue(
+                '(//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"])[position()>1]',  # noqa
+                sub_attributes=[
+                    FirstInOrderValue([
+                        XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL/text()'),  # noqa
+                    ]),
+                    XPathValue('.//gmd:description/gco:CharacterString/text()'),  # noqa
+                ]
+            ),
+            XPathSubValue(
+                '(//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"])[position()>1]',  # noqa
+                sub_attributes=[
+                    FirstInOrderValue([
+                        XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL/text()'),  # noqa
+                    ]),
+                    XPathValue('.//gmd:description/gco:CharacterString/text()'),  # noqa
+                ]
+            ),
+            XPathSubValue(
+                '(//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "CHTOPO:specialised-geoportal"])',  # noqa
+                sub_attributes=[
+                    FirstInOrderValue([
+                        XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
+                        XPathValue('.//che:LocalisedURL/text()'),  # noqa
+                    ]),
+                    XPathValue('.//gmd:description/gco:CharacterString/text()'),  # noqa
+                ]
+            ),
+        ]
+    ),
+    'keywords_de': XPathMultiValue('//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString[@locale="#DE"]/text()'),  # noqa
+    'keywords_fr': XPathMultiValue('//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString[@locale="#FR"]/text()'),  # noqa
+    'keywords_it': XPathMultiValue('//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString[@locale="#IT"]/text()'),  # noqa
+    'keywords_en': XPathMultiValue('//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString[@locale="#EN"]/text()'),  # noqa
+    'url': FirstInOrderValue([
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
+        XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL/text()'),  # noqa
+    ]),
+    'spatial': XPathValue('//gmd:identificationInfo//gmd:extent//gmd:description/gco:CharacterString/text()'),  # noqa
+    'coverage': StringValue(''),  # noqa
+    'temporals_start': XPathValue('//gmd:identificationInfo//gmd:extent//gmd:temporalElement//gml:TimePeriod/gml:beginPosition/text()'),  # noqa
+    'temporals_end': XPathValue('//gmd:identificationInfo//gmd:extent//gmd:temporalElement//gml:TimePeriod/gml:endPosition/text()'),  # noqa
+    'accrual_periodicity': XPathValue('//gmd:identificationInfo//che:CHE_MD_MaintenanceInformation/gmd:maintenanceAndUpdateFrequency/gmd:MD_MaintenanceFrequencyCode/@codeListValue'),  # noqa
+    'see_alsos': XPathMultiValue('//gmd:identificationInfo//gmd:aggregationInfo//gmd:aggregateDataSetIdentifier/gmd:MD_Identifier/gmd:code/gco:CharacterString/text()'),  # noqa
+    'rights': FirstInOrderValue(
+        [
+            XPathValue('.//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString[@locale = "#DE" and ./text()]/text()'),  # noqa
+            XPathValue('.//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString[@locale = "#FR" and ./text()]/text()'),  # noqa
+        ]
+    ),
+}
+
+
 class GeocatDcatDatasetMetadata(DcatMetadata):
-    """ Provides access to the Geocat metadata """
-    def __init__(self):
+    """
+    Provides access to the Geocat metadata
+
+    The values are either extracted by evaluating the XPaths of the
+    mapping ('xpath' engine) or by walking the document once
+    ('stream' engine, see ckanext.geocat.streaming).
+    """
+    ENGINES = ('xpath', 'stream', 'xslt')
+
+    def __init__(self, engine='xpath'):
         super(GeocatDcatDatasetMetadata, self).__init__()
-        self.csw = CswHelper('http://www.geocat.ch/geonetwork/srv/eng/csw')
-        self.dist = GeocatDcatDistributionMetadata()
+        if engine not in self.ENGINES:
+            raise ValueError("Unknown extraction engine '%s'" % engine)
+        if engine == 'stream' and not streaming.supports(self.get_mapping()):
+            log.warning('The rules of the stream engine do not match the '
+                        'mapping, using the xpath engine')
+            engine = 'xpath'
+        self.engine = engine
 
     def get_metadata(self, xml_elem):
-        dataset = self.load(xml_elem)
+        context = _get_context(xml_elem)
+        dataset = _copy_values(context.load_dataset(self)[0])
 
         if 'temporals' not in dataset:
             dataset['temporals'] = []
@@ -281,171 +633,61 @@ class GeocatDcatDatasetMetadata(DcatMetadata):
         if 'id' not in dataset:
             dataset['id'] = ''
 
-        lang_mapping = {
-            'ger': 'de',
-            'fra': 'fr',
-            'eng': 'en',
-            'ita': 'it',
-        }
         try:
-            language = [lang_mapping[dataset['language']]]
+            language = [language_mapping[dataset['language']]]
         except KeyError:
             language = []
         dataset['language'] = language
 
         return dataset
 
+    def extract(self, meta_xml, index=None):
+        if self.engine == 'stream':
+            return streaming.extract_dataset(meta_xml)
+        results = None
+        if self.engine == 'xslt':
+            stylesheet = xslt.get_stylesheet(self.get_plan())
+            results = stylesheet.evaluate(meta_xml)
+        return super(GeocatDcatDatasetMetadata, self).extract(
+            meta_xml,
+            index,
+            results
+        )
+
     def get_mapping(self):
-        return {
-            'identifier': XPathValue('//gmd:fileIdentifier/gco:CharacterString/text()'),  # noqa
-            'title_de': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#DE"]/text()'),  # noqa
-            'title_fr': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#FR"]/text()'),  # noqa
-            'title_it': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#IT"]/text()'),  # noqa
-            'title_en': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#EN"]/text()'),  # noqa
-            'description_de': XPathValue('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#DE"]/text()'),  # noqa
-            'description_fr': XPathValue('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#FR"]/text()'),  # noqa
-            'description_it': XPathValue('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#IT"]/text()'),  # noqa
-            'description_en': XPathValue('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#EN"]/text()'),  # noqa
-            'issued': FirstInOrderValue(
-                [
-                    XPathValue('//gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "publication"]//gco:DateTime/text() | //gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "publication"]//gco:Date/text()'),  # noqa
-                    XPathValue('//gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "creation"]//gco:DateTime/text() | //gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "creation"]//gco:Date/text()'),  # noqa
-                    XPathValue('//gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "revision"]//gco:DateTime/text() | //gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "revision"]//gco:Date/text()'),  # noqa
-                ]
-            ),
-            'modified': XPathValue('//gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "revision"]//gco:DateTime/text() | //gmd:identificationInfo//gmd:citation//gmd:CI_Date[.//gmd:CI_DateTypeCode/@codeListValue = "revision"]//gco:Date/text()'),  # noqa
-            'publishers': ArrayValue([
-                FirstInOrderValue(
-                    [
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "publisher"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "owner"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "pointOfContact"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "distributor"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "custodian"]//gmd:organisationName/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:contact//che:CHE_CI_ResponsibleParty//gmd:organisationName/gco:CharacterString'),  # noqa
-                    ]
-                )
-            ]),
-            'contact_points': ArrayValue([
-                FirstInOrderValue(
-                    [
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "publisher"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "owner"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "pointOfContact"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "distributor"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:identificationInfo//gmd:pointOfContact[.//gmd:CI_RoleCode/@codeListValue = "custodian"]//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
-                        XPathValue('//gmd:contact//che:CHE_CI_ResponsibleParty//gmd:address//gmd:electronicMailAddress/gco:CharacterString/text()'),  # noqa
-                    ]
-                )
-            ]),
-            'groups': XPathMultiValue('//gmd:identificationInfo//gmd:topicCategory/gmd:MD_TopicCategoryCode/text()'),  # noqa
-            'language': FirstInOrderValue(
-                [
-                    XPathValue('//gmd:identificationInfo//gmd:language/gco:CharacterString/text()'),  # noqa
-                    XPathValue('//che:CHE_MD_Metadata/gmd:language/gco:CharacterString/text()'),  # noqa
-                ]
-            ),
-            'relations': ArrayValue(
-                [
-                    XPathSubValue(
-                        '(//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"])[position()>1]',  # noqa
-                        sub_attributes=[
-                            FirstInOrderValue([
-                                XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL/text()'),  # noqa
-                            ]),
-                            XPathValue('.//gmd:description/gco:CharacterString/text()'),  # noqa
-                        ]
-                    ),
-                    XPathSubValue(
-                        '(//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"])[position()>1]',  # noqa
-                        sub_attributes=[
-                            FirstInOrderValue([
-                                XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL/text()'),  # noqa
-                            ]),
-                            XPathValue('.//gmd:description/gco:CharacterString/text()'),  # noqa
-                        ]
-                    ),
-                    XPathSubValue(
-                        '(//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "CHTOPO:specialised-geoportal"])',  # noqa
-                        sub_attributes=[
-                            FirstInOrderValue([
-                                XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
-                                XPathValue('.//che:LocalisedURL/text()'),  # noqa
-                            ]),
-                            XPathValue('.//gmd:description/gco:CharacterString/text()'),  # noqa
-                        ]
-                    ),
-                ]
-            ),
-            'keywords_de': XPathMultiValue('//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString[@locale="#DE"]/text()'),  # noqa
-            'keywords_fr': XPathMultiValue('//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString[@locale="#FR"]/text()'),  # noqa
-            'keywords_it': XPathMultiValue('//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString[@locale="#IT"]/text()'),  # noqa
-            'keywords_en': XPathMultiValue('//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString[@locale="#EN"]/text()'),  # noqa
-            'url': FirstInOrderValue([
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK"]//che:LocalisedURL/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
-                XPathValue('//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:LINK-1.0-http--link"]//che:LocalisedURL/text()'),  # noqa
-            ]),
-            'spatial': XPathValue('//gmd:identificationInfo//gmd:extent//gmd:description/gco:CharacterString/text()'),  # noqa
-            'coverage': StringValue(''),  # noqa
-            'temporals_start': XPathValue('//gmd:identificationInfo//gmd:extent//gmd:temporalElement//gml:TimePeriod/gml:beginPosition/text()'),  # noqa
-            'temporals_end': XPathValue('//gmd:identificationInfo//gmd:extent//gmd:temporalElement//gml:TimePeriod/gml:endPosition/text()'),  # noqa
-            'accrual_periodicity': XPathValue('//gmd:identificationInfo//che:CHE_MD_MaintenanceInformation/gmd:maintenanceAndUpdateFrequency/gmd:MD_MaintenanceFrequencyCode/@codeListValue'),  # noqa
-            'see_alsos': XPathMultiValue('//gmd:identificationInfo//gmd:aggregationInfo//gmd:aggregateDataSetIdentifier/gmd:MD_Identifier/gmd:code/gco:CharacterString/text()'),  # noqa
-            'rights': FirstInOrderValue(
-                [
-                    XPathValue('.//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString[@locale = "#DE" and ./text()]/text()'),  # noqa
-                    XPathValue('.//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString[@locale = "#FR" and ./text()]/text()'),  # noqa
-                ]
-            ),
-        }
+        return dataset_mapping
 
 
 class GeocatDcatDistributionMetadata(DcatMetadata):
     """ Provides access to the Geocat metadata """
     def __init__(self):
         super(GeocatDcatDistributionMetadata, self).__init__()
-        self.csw = CswHelper('http://www.geocat.ch/geonetwork/srv/eng/csw')
+        self._handlers = None
 
     def get_metadata(self, xml):
-        dataset_meta = self._get_dataset_metadata(xml)
+        context = _get_context(xml)
+        dataset_meta = self._get_dataset_metadata(context)
         distributions = []
 
-        # handle downloads
-        download_dist = GeocatDcatDownloadDistributionMetadata()
-        download_dists = download_dist.get_metadata(xml, dataset_meta)
-        distributions.extend(download_dists)
-
-        # handle services
-        service_dist = GeocatDcatServiceDistributionMetadata()
-        service_dists = service_dist.get_metadata(xml, dataset_meta)
-        distributions.extend(service_dists)
-
-        # handle service datasets
-        service_dataset = GeocatDcatServiceDatasetMetadata()
-        service_datasets = service_dataset.get_metadata(xml, dataset_meta)
-        distributions.extend(service_datasets)
+        # handle downloads, services and service datasets
+        for handler in self._get_handlers():
+            distributions.extend(handler.get_metadata(context, dataset_meta))
 
         return distributions
 
+    def _get_handlers(self):
+        """
+        Returns the metadata instances of the distribution types,
+        they are created once and reused for all records
+        """
+        if self._handlers is None:
+            self._handlers = (
+                GeocatDcatDownloadDistributionMetadata(),
+                GeocatDcatServiceDistributionMetadata(),
+                GeocatDcatServiceDatasetMetadata(),
+            )
+        return self._handlers
+
     # Use the original dist as template to create a new dist.
     # and delete the url_list on the copy as we don't need it afterwards.
     def _create_dist_copy(self, orig_dist, access_url):
@@ -455,25 +697,22 @@ class GeocatDcatDistributionMetadata(DcatMetadata):
         del dist['url_list']
         return dist
 
-    def _get_dataset_metadata(self, xml):
-        dataset = GeocatDcatDatasetMetadata()
+    def _get_dataset_metadata(self, context):
+        xml = context.xml
+        index = context.index
 
-        # TODO: include_raw is an ugly hack to be able to get all extracted
-        # attributes. In this case we need to access the 'rights' attribute,
-        # which we extract on the dataset level. It is not available otherwise
-        # on the distribution level. Since we "clean" the dataset after the
-        # extraction (i.e. only the allowed attributes stay in the dict) we
-        # need to access the "raw" dataset metadata to get the value anyway.
-        # We should refactor this, to i.e. make the complete data always
-        # available to the distributions
-        dataset_meta, raw_meta = dataset.load(xml, include_raw=True)
+        # The 'rights' attribute is extracted on the dataset level but only
+        # needed on the distributions. It is removed when the dataset is
+        # cleaned, so it is taken from the raw values of the context.
+        dataset_meta, raw_meta = context.load_dataset()
+        dataset_meta = dict(dataset_meta)
 
         # copy rights from raw metadata
         dataset_meta['rights'] = raw_meta.get('rights')
 
         # add media_type to dataset metadata
         dataset_meta['media_type'] = ''
-        service_media_type = loader.xpath(xml, '//gmd:identificationInfo//srv:serviceType/gco:LocalName/text()')  # noqa
+        service_media_type = loader.xpath(xml, '//gmd:identificationInfo//srv:serviceType/gco:LocalName/text()', index)  # noqa
         dist_media_type = loader.xpath(xml, '//gmd:distributionInfo//gmd:distributionFormat//gmd:name//gco:CharacterString/text()')  # noqa
 
         if service_media_type:
@@ -503,20 +742,8 @@ class GeocatDcatDistributionMetadata(DcatMetadata):
                 dist['language'].append(loc)
         del dist['loc_url']
 
-        protocol_title = {
-            "OGC:WMTS-http-get-capabilities": "WMTS (GetCapabilities)",
-            "OGC:WMS-http-get-map": "WMS (GetMap)",
-            "OGC:WMS-http-get-capabilities": "WMS (GetCapabilities)",
-            "OGC:WFS-http-get-capabilities": "WFS (GetCapabilities)",
-            "WWW:DOWNLOAD-1.0-http--download": "Download",
-            "WWW:DOWNLOAD-URL": "Download",
-            "OGC:WMS": "WMS (GetMap)",
-            "OGC:WFS": "WFS (GetCapabilities)",
-            "OGC:WMTS": "WMTS (GetCapabilities)",
-            "WWW:DOWNLOAD-FTP": "Download",
-        }
         try:
-            title = protocol_title[dist['protocol']]
+            title = protocol_title_mapping[dist['protocol']]
         except KeyError:
             title = ''
         if dist['name']:
@@ -533,21 +760,8 @@ class GeocatDcatDistributionMetadata(DcatMetadata):
             dist['title'] = dict(dist['description'])
 
         # map rights
-        rights = {
-            u'Freie Nutzung': 'NonCommercialAllowed-CommercialAllowed-ReferenceNotRequired',  # noqa
-            u'Utilisation libre': 'NonCommercialAllowed-CommercialAllowed-ReferenceNotRequired',  # noqa
-
-            u'Freie Nutzung. Quellenangabe ist Pflicht.': 'NonCommercialAllowed-CommercialAllowed-ReferenceRequired',  # noqa
-            u'Utilisation libre. Obligation d’indiquer la source.': 'NonCommercialAllowed-CommercialAllowed-ReferenceRequired',  # noqa
-
-            u'Freie Nutzung. Kommerzielle Nutzung nur mit Bewilligung des Datenlieferanten zulässig.': 'NonCommercialAllowed-CommercialWithPermission-ReferenceNotRequired',  # noqa
-            u'Utilisation libre. Utilisation à des fins commerciales uniquement avec l’autorisation du fournisseur des données.': 'NonCommercialAllowed-CommercialWithPermission-ReferenceNotRequired',  # noqa
-
-            u'Freie Nutzung. Quellenangabe ist Pflicht. Kommerzielle Nutzung nur mit Bewilligung des Datenlieferanten zulässig.': 'NonCommercialAllowed-CommercialWithPermission-ReferenceRequired',  # noqa
-            u'Utilisation libre. Obligation d’indiquer la source. Utilisation commerciale uniquement avec l’autorisation du fournisseur des données.': 'NonCommercialAllowed-CommercialWithPermission-ReferenceRequired' # noqa
-        }
-        if dataset_meta.get('rights') in rights:
-            dist['rights'] = rights[dataset_meta['rights']]
+        if dataset_meta.get('rights') in rights_mapping:
+            dist['rights'] = rights_mapping[dataset_meta['rights']]
         else:
             dist['rights'] = ''
         del dist['name']
@@ -561,12 +775,52 @@ class GeocatDcatDistributionMetadata(DcatMetadata):
         return dist
 
 
+download_distribution_mapping = {
+    'name': XPathValue('.//gmd:name/gco:CharacterString/text()'),
+    'protocol': XPathValue('.//gmd:protocol/gco:CharacterString/text()'),  # noqa
+    'language': StringValue(''),  # noqa
+    # 'download_url' and 'url' are set to empty, their
+    # values will be determined and set later from 'url_list'
+    'download_url': StringValue(''),  # noqa
+    'url': StringValue(''),  # noqa
+    'url_list': FirstInOrderValue(
+        [
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#DE" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#FR" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#EN" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#IT" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//gmd:URL[./text()]/text()'),   # noqa
+        ]
+    ),
+    'description_de': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#DE"]/text()'),  # noqa
+    'description_fr': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#FR"]/text()'),  # noqa
+    'description_it': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#IT"]/text()'),  # noqa
+    'description_en': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#EN"]/text()'),  # noqa
+    'loc_url_de': XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
+    'loc_url_fr': XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
+    'loc_url_it': XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
+    'loc_url_en': XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
+    'license': StringValue(''),  # noqa
+    'identifier': StringValue(''),  # noqa
+    'rights': StringValue(''),
+    'byte_size': StringValue(''),
+    'media_type': StringValue(''),
+    'format': StringValue(''),
+    'coverage': StringValue(''),
+}
+
+
 class GeocatDcatDownloadDistributionMetadata(GeocatDcatDistributionMetadata):
     """ Provides access to the Geocat metadata """
+    overwritten_fields = (
+        'language', 'rights', 'format', 'media_type', 'url', 'download_url'
+    )
 
     def get_metadata(self, xml, dataset_meta):
+        context = _get_context(xml)
         download_distributions = []
-        for dist_xml in loader.xpath(xml, '//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:DOWNLOAD-1.0-http--download" or .//gmd:protocol/gco:CharacterString/text() = "WWW:DOWNLOAD-URL"]'):  # noqa
+        for dist_xml in loader.xpath(context.xml, '//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "WWW:DOWNLOAD-1.0-http--download" or .//gmd:protocol/gco:CharacterString/text() = "WWW:DOWNLOAD-URL"]', context.index):  # noqa
             orig_dist = self._handle_single_distribution(
                 dist_xml,
                 dataset_meta
@@ -583,40 +837,7 @@ class GeocatDcatDownloadDistributionMetadata(GeocatDcatDistributionMetadata):
         return download_distributions
 
     def get_mapping(self):
-        return {
-            'name': XPathValue('.//gmd:name/gco:CharacterString/text()'),
-            'protocol': XPathValue('.//gmd:protocol/gco:CharacterString/text()'),  # noqa
-            'language': StringValue(''),  # noqa
-            # 'download_url' and 'url' are set to empty, their
-            # values will be determined and set later from 'url_list'
-            'download_url': StringValue(''),  # noqa
-            'url': StringValue(''),  # noqa
-            'url_list': FirstInOrderValue(
-                [
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#DE" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#FR" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#EN" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#IT" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//gmd:URL[./text()]/text()'),   # noqa
-                ]
-            ),
-            'description_de': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#DE"]/text()'),  # noqa
-            'description_fr': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#FR"]/text()'),  # noqa
-            'description_it': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#IT"]/text()'),  # noqa
-            'description_en': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#EN"]/text()'),  # noqa
-            'loc_url_de': XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
-            'loc_url_fr': XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
-            'loc_url_it': XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
-            'loc_url_en': XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
-            'license': StringValue(''),  # noqa
-            'identifier': StringValue(''),  # noqa
-            'rights': StringValue(''),
-            'byte_size': StringValue(''),
-            'media_type': StringValue(''),
-            'format': StringValue(''),
-            'coverage': StringValue(''),
-        }
+        return download_distribution_mapping
 
     # Use the original dist as template to create a new dist.
     # Also set the url to the access_url (and the download_url if it exists)
@@ -637,12 +858,46 @@ class GeocatDcatDownloadDistributionMetadata(GeocatDcatDistributionMetadata):
         return dist
 
 
+service_distribution_mapping = {
+    'name': XPathValue('.//gmd:name/gco:CharacterString/text()'),  # noqa
+    'protocol': XPathValue('.//gmd:protocol/gco:CharacterString/text()'),  # noqa
+    'language': ArrayValue([]),  # noqa
+    'url_list': FirstInOrderValue(
+        [
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#DE" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#FR" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#EN" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#IT" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//gmd:linkage//che:LocalisedURL[./text()]/text()'),  # noqa
+        ]
+    ),
+    'download_url': StringValue(''),  # noqa
+    'description_de': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#DE"]/text()'),  # noqa
+    'description_fr': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#FR"]/text()'),  # noqa
+    'description_it': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#IT"]/text()'),  # noqa
+    'description_en': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#EN"]/text()'),  # noqa
+    'loc_url_de': XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
+    'loc_url_fr': XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
+    'loc_url_it': XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
+    'loc_url_en': XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
+    'license': StringValue(''),  # noqa
+    'identifier': StringValue(''),  # noqa
+    'rights': StringValue(''),  # noqa
+    'byte_size': StringValue(''),  # noqa
+    'media_type': StringValue(''),  # noqa
+    'format': StringValue(''),  # noqa
+    'coverage': StringValue(''),  # noqa
+}
+
+
 class GeocatDcatServiceDistributionMetadata(GeocatDcatDistributionMetadata):
     """ Provides access to the Geocat metadata """
+    overwritten_fields = ('language', 'rights', 'format', 'media_type', 'url')
 
     def get_metadata(self, xml, dataset_meta):
+        context = _get_context(xml)
         service_distributions = []
-        for dist_xml in loader.xpath(xml, '//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "OGC:WFS" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMTS" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMS" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMTS-http-get-capabilities" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMS-http-get-map" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMS-http-get-capabilities" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WFS-http-get-capabilities"]'):  # noqa
+        for dist_xml in loader.xpath(context.xml, '//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions//gmd:CI_OnlineResource[.//gmd:protocol/gco:CharacterString/text() = "OGC:WFS" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMTS" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMS" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMTS-http-get-capabilities" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMS-http-get-map" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WMS-http-get-capabilities" or .//gmd:protocol/gco:CharacterString/text() = "OGC:WFS-http-get-capabilities"]', context.index):  # noqa
             orig_dist = self._handle_single_distribution(
                 dist_xml,
                 dataset_meta
@@ -659,44 +914,52 @@ class GeocatDcatServiceDistributionMetadata(GeocatDcatDistributionMetadata):
         return service_distributions
 
     def get_mapping(self):
-        return {
-            'name': XPathValue('.//gmd:name/gco:CharacterString/text()'),  # noqa
-            'protocol': XPathValue('.//gmd:protocol/gco:CharacterString/text()'),  # noqa
-            'language': ArrayValue([]),  # noqa
-            'url_list': FirstInOrderValue(
-                [
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#DE" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#FR" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#EN" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[@locale = "#IT" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//gmd:linkage//che:LocalisedURL[./text()]/text()'),  # noqa
-                ]
-            ),
-            'download_url': StringValue(''),  # noqa
-            'description_de': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#DE"]/text()'),  # noqa
-            'description_fr': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#FR"]/text()'),  # noqa
-            'description_it': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#IT"]/text()'),  # noqa
-            'description_en': XPathValue('.//gmd:description//gmd:LocalisedCharacterString[@locale = "#EN"]/text()'),  # noqa
-            'loc_url_de': XPathValue('.//che:LocalisedURL[@locale = "#DE"]/text()'),  # noqa
-            'loc_url_fr': XPathValue('.//che:LocalisedURL[@locale = "#FR"]/text()'),  # noqa
-            'loc_url_it': XPathValue('.//che:LocalisedURL[@locale = "#IT"]/text()'),  # noqa
-            'loc_url_en': XPathValue('.//che:LocalisedURL[@locale = "#EN"]/text()'),  # noqa
-            'license': StringValue(''),  # noqa
-            'identifier': StringValue(''),  # noqa
-            'rights': StringValue(''),  # noqa
-            'byte_size': StringValue(''),  # noqa
-            'media_type': StringValue(''),  # noqa
-            'format': StringValue(''),  # noqa
-            'coverage': StringValue(''),  # noqa
-        }
+        return service_distribution_mapping
+
+
+service_dataset_mapping = {
+    'title_de': XPathValue('.//srv:operationName/gco:CharacterString/text()'),  # noqa
+    'title_fr': XPathValue('.//srv:operationName/gco:CharacterString/text()'),  # noqa
+    'title_it': XPathValue('.//srv:operationName/gco:CharacterString/text()'),  # noqa
+    'title_en': XPathValue('.//srv:operationName/gco:CharacterString/text()'),  # noqa
+    'language': ArrayValue([]),  # noqa
+    'url': StringValue(''),  # noqa
+    'url_list': FirstInOrderValue(
+        [
+            XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[@locale = "#DE" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[@locale = "#FR" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[@locale = "#EN" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[@locale = "#IT" and ./text()]/text()'),  # noqa
+            XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[./text()]/text()'),  # noqa
+        ]
+    ),
+    'description': StringValue(''),
+    'license': StringValue(''),  # noqa
+    'identifier': StringValue(''),  # noqa
+    'download_url': StringValue(''),  # noqa
+    'byte_size': StringValue(''),  # noqa
+    'media_type': StringValue(''),  # noqa
+    'format': StringValue(''),  # noqa
+    'coverage': StringValue(''),  # noqa
+    'rights': FirstInOrderValue(
+        [
+            XPathValue('.//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString[@locale = "#DE" and ./text()]/text()'),  # noqa
+            XPathValue('.//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString[@locale = "#FR" and ./text()]/text()'),  # noqa
+        ]
+    ),
+}
 
 
 class GeocatDcatServiceDatasetMetadata(GeocatDcatDistributionMetadata):
     """ Provides access to the Geocat metadata """
+    overwritten_fields = (
+        'description', 'rights', 'format', 'media_type', 'url'
+    )
 
     def get_metadata(self, xml, dataset_meta):
+        context = _get_context(xml)
         service_datasets = []
-        for dist_xml in loader.xpath(xml, '//gmd:identificationInfo//srv:containsOperations/srv:SV_OperationMetadata[.//srv:operationName//gco:CharacterString/text()]'):  # noqa
+        for dist_xml in loader.xpath(context.xml, '//gmd:identificationInfo//srv:containsOperations/srv:SV_OperationMetadata[.//srv:operationName//gco:CharacterString/text()]', context.index):  # noqa
             orig_dist = super(GeocatDcatServiceDatasetMetadata, self).load(dist_xml)  # noqa
             orig_dist['description'] = dataset_meta['description']
             orig_dist['issued'] = dataset_meta['issued']
@@ -715,46 +978,185 @@ class GeocatDcatServiceDatasetMetadata(GeocatDcatDistributionMetadata):
         return service_datasets
 
     def get_mapping(self):
-        return {
-            'title_de': XPathValue('.//srv:operationName/gco:CharacterString/text()'),  # noqa
-            'title_fr': XPathValue('.//srv:operationName/gco:CharacterString/text()'),  # noqa
-            'title_it': XPathValue('.//srv:operationName/gco:CharacterString/text()'),  # noqa
-            'title_en': XPathValue('.//srv:operationName/gco:CharacterString/text()'),  # noqa
-            'language': ArrayValue([]),  # noqa
-            'url': StringValue(''),  # noqa
-            'url_list': FirstInOrderValue(
-                [
-                    XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[@locale = "#DE" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[@locale = "#FR" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[@locale = "#EN" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[@locale = "#IT" and ./text()]/text()'),  # noqa
-                    XPathMultiValue('.//srv:connectPoint//gmd:linkage//che:LocalisedURL[./text()]/text()'),  # noqa
-                ]
-            ),
-            'description': StringValue(''),
-            'license': StringValue(''),  # noqa
-            'identifier': StringValue(''),  # noqa
-            'download_url': StringValue(''),  # noqa
-            'byte_size': StringValue(''),  # noqa
-            'media_type': StringValue(''),  # noqa
-            'format': StringValue(''),  # noqa
-            'coverage': StringValue(''),  # noqa
-            'rights': FirstInOrderValue(
-                [
-                    XPathValue('.//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString[@locale = "#DE" and ./text()]/text()'),  # noqa
-                    XPathValue('.//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString[@locale = "#FR" and ./text()]/text()'),  # noqa
-                ]
-            ),
-        }
+        return service_dataset_mapping
+
+
+# HTTP sessions per process and CSW endpoint, see get_session
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url, pool_size=10):
+    """
+    Returns the requests session of the endpoint (scheme and host) of the
+    url. The session is only created once per process and keeps up to
+    pool_size connections alive, so the requests of all CswHelpers to the
+    same server reuse their connections. The pool size of the first call
+    for an endpoint is used.
+    """
+    parts = urlparse(url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        try:
+            return _sessions[key]
+        except KeyError:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_size
+            )
+            session.mount('%s://' % parts.scheme, adapter)
+            _sessions[key] = session
+            return session
 
 
 class GeocatCatalogueServiceWeb(CatalogueServiceWeb):
+    # the root elements of valid CSW responses
+    valid_roots = [
+        util.nspath_eval(tag, csw_namespaces) for tag in (
+            'ows:ExceptionReport',
+            'csw:Capabilities',
+            'csw:DescribeRecordResponse',
+            'csw:GetDomainResponse',
+            'csw:GetRecordsResponse',
+            'csw:GetRecordByIdResponse',
+            'csw:HarvestResponse',
+            'csw:TransactionResponse',
+        )
+    ]
+
     def __init__(self, *args, **kwargs):
         self.xml_elem = defaultdict()
+        self.serialized = {}
+        self.datestamps = {}
+        # the records of the last response read by stream_records
+        self._streamed = None
+        # the element set of the last request, only 'full' records are
+        # serialized by stream_records
+        self._esn = None
+        self.pool_size = kwargs.pop('pool_size', 10)
+        # the ResponseCache of the requests, if any
+        self.cache = kwargs.pop('cache', None)
+        # build MD_Metadata objects of summary records
+        self.parse_metadata = kwargs.pop('parse_metadata', True)
         super(GeocatCatalogueServiceWeb, self).__init__(*args, **kwargs)
 
+    def getrecords(self, *args, **kwargs):
+        # the element set is always passed by keyword in this module
+        self._esn = kwargs.get('esn', 'summary')
+        return super(GeocatCatalogueServiceWeb, self).getrecords(
+            *args, **kwargs
+        )
+
+    def getrecordbyid(self, *args, **kwargs):
+        self._esn = kwargs.get('esn', 'full')
+        return super(GeocatCatalogueServiceWeb, self).getrecordbyid(
+            *args, **kwargs
+        )
+
+    def _invoke(self):
+        """
+        Sends the request with the pooled session of the endpoint (see
+        get_session) instead of a new connection per request. If the
+        capabilities have been loaded, owslib picks the URL per operation.
+        """
+        if hasattr(self, 'operations'):
+            return super(GeocatCatalogueServiceWeb, self)._invoke()
+
+        if isinstance(self.request, basestring):  # GET KVP
+            self.request = '%s%s' % (util.bind_url(self.url), self.request)
+            response, cache_key = self._send('GET', self.request)
+            if response.status_code in (400, 401):
+                raise util.ServiceException(response.text)
+        else:
+            self.request = util.cleanup_namespaces(self.request)
+            for query in self.request.findall(util.nspath_eval('csw:Query', csw_namespaces)):  # noqa
+                typenames = query.get('typeNames')
+                if typenames is not None:
+                    self.request = util.add_namespaces(
+                        self.request,
+                        [name.split(':')[0] for name in typenames.split(' ')]
+                    )
+            self.request = util.element_to_string(
+                self.request,
+                encoding='utf-8'
+            )
+            response, cache_key = self._send(
+                'POST',
+                self.url,
+                data=self.request,
+                headers={
+                    'Content-type': 'text/xml',
+                    'Accept': 'text/xml',
+                    'Accept-Language': self.lang,
+                }
+            )
+        if response.status_code == 404:
+            response.raise_for_status()
+        self.response = response.content
+        self._parseresponse()
+        # only valid CSW responses are cached
+        if cache_key is not None and response.status_code == 200:
+            self.cache.put(cache_key, response)
+
+    def _send(self, method, url, data=None, headers=None):
+        """
+        Sends the request, unless the cache has a fresh response. Returns
+        the response and the cache key to store it with (None if it does
+        not have to be stored).
+        """
+        session = get_session(self.url, self.pool_size)
+        headers = dict(headers or {})
+        kwargs = {'data': data, 'timeout': self.timeout}
+        if self.username and self.password:
+            kwargs['auth'] = (self.username, self.password)
+
+        if self.cache is None:
+            response = session.request(method, url, headers=headers, **kwargs)
+            return response, None
+
+        key = self.cache.get_key(method, url, data)
+        entry = self.cache.get(key)
+        if entry is not None and entry.is_fresh(self.cache.ttl):
+            return entry.get_response(), None
+        if entry is not None:
+            headers.update(entry.get_conditional_headers())
+
+        response = session.request(method, url, headers=headers, **kwargs)
+        if entry is not None and response.status_code == 304:
+            self.cache.refresh(key)
+            return entry.get_response(), None
+        return response, key
+
+    def _parseresponse(self):
+        """
+        Parses the response like owslib, the records are read one at a
+        time with stream_records, unless MD_Metadata objects are built
+        """
+        if self.parse_metadata:
+            self._exml = etree.parse(BytesIO(self.response))
+        else:
+            self._exml, self._streamed = stream_records(
+                self.response,
+                serialize=(self._esn == 'full')
+            )
+        if self._exml.getroot().tag not in self.valid_roots:
+            raise RuntimeError('Document is XML, but not CSW-ish')
+
+        val = self._exml.find(util.nspath_eval('ows:Exception', csw_namespaces))  # noqa
+        if val is not None:
+            raise ows.ExceptionReport(self._exml, self.owscommon.namespace)
+        else:
+            self.exceptionreport = None
+
     def _parserecords(self, outputschema, esn):
-        if outputschema == loader.namespaces['che']:
+        self.xml_elem = defaultdict()
+        self.serialized = {}
+        self.datestamps = {}
+        light = esn in ('brief', 'full') or not self.parse_metadata
+        if outputschema == loader.namespaces['che'] and light:
+            self._parseidentifiers(keep_elements=(esn != 'brief'))
+        elif outputschema == loader.namespaces['che']:
             for i in self._exml.findall('//'+util.nspath('CHE_MD_Metadata', loader.namespaces['che'])):  # noqa
                 val = i.find(util.nspath('fileIdentifier', loader.namespaces['gmd']) + '/' + util.nspath('CharacterString', loader.namespaces['gco']))  # noqa
                 identifier = self._setidentifierkey(util.testXMLValue(val))
@@ -765,35 +1167,197 @@ class GeocatCatalogueServiceWeb(CatalogueServiceWeb):
                 GeocatCatalogueServiceWeb, self
             )._parserecords(outputschema, esn)
 
+    def _parseidentifiers(self, keep_elements=False):
+        """
+        Only reads the identifiers and date stamps of the records, no
+        MD_Metadata is built. The records map the identifiers to
+        themselves, the records are only kept (see get_xml) if
+        keep_elements is True.
+        """
+        if self._streamed is not None:
+            records = self._streamed
+            self._streamed = None
+        else:
+            results = self._exml.find('csw:SearchResults', loader.namespaces)
+            if results is None:
+                # GetRecordById returns the records without search results
+                results = self._exml.getroot()
+            records = [
+                _read_record(record) + (record,)
+                for record in results.iterfind('*')
+            ]
+        for identifier, datestamp, record in records:
+            identifier = self._setidentifierkey(identifier)
+            self.records[identifier] = identifier
+            self.datestamps[identifier] = datestamp
+            if keep_elements and etree.iselement(record):
+                self.xml_elem[identifier] = record
+            elif keep_elements and record is not None:
+                self.serialized[identifier] = record
+
+    def get_xml(self, identifier):
+        """ Returns the serialized record with the identifier """
+        try:
+            return self.serialized[identifier]
+        except KeyError:
+            return etree.tostring(self.xml_elem[identifier], encoding='utf-8')
+
+
+# the elements of the records in CSW responses and their parents
+RECORD_TAGS = [
+    util.nspath_eval(tag, loader.namespaces) for tag in (
+        'che:CHE_MD_Metadata',
+        'gmd:MD_Metadata',
+        'csw:Record',
+        'csw:BriefRecord',
+        'csw:SummaryRecord',
+    )
+]
+RECORD_PARENTS = [
+    util.nspath_eval('csw:SearchResults', loader.namespaces),
+    util.nspath_eval('csw:GetRecordByIdResponse', loader.namespaces),
+]
+
+
+def _read_record(record):
+    """ Returns the identifier and the date stamp of the record element """
+    identifier = util.testXMLValue(record.find(
+        'gmd:fileIdentifier/gco:CharacterString',
+        loader.namespaces
+    ))
+    datestamp = util.testXMLValue(record.find(
+        'gmd:dateStamp/gco:DateTime',
+        loader.namespaces
+    )) or util.testXMLValue(record.find(
+        'gmd:dateStamp/gco:Date',
+        loader.namespaces
+    ))
+    return identifier, datestamp
+
+
+def stream_records(response, serialize=True):
+    """
+    Parses a CSW response one record at a time. Returns the document
+    without its records and a list of (identifier, datestamp, xml) tuples,
+    xml is the serialized record (None unless serialize is True). Every
+    record is removed from the tree as soon as it is read, so the tree of
+    the whole response is never built.
+    """
+    records = []
+    parser = etree.iterparse(BytesIO(response), tag=RECORD_TAGS)
+    for event, record in parser:
+        parent = record.getparent()
+        if parent is None or parent.tag not in RECORD_PARENTS:
+            # e.g. a record nested in another record
+            continue
+        xml = None
+        if serialize:
+            xml = etree.tostring(record, encoding='utf-8')
+        records.append(_read_record(record) + (xml,))
+        # the records already read are removed from the tree
+        record.clear()
+        while record.getprevious() is not None:
+            del parent[0]
+    return parser.root.getroottree(), records
+
 
 class CswHelper(object):
-    def __init__(self, url='http://www.geocat.ch/geonetwork/srv/eng/csw'):
-        self.catalog = GeocatCatalogueServiceWeb(url, skip_caps=True)
+    def __init__(self, url='http://www.geocat.ch/geonetwork/srv/eng/csw',
+                 page_size=50, workers=1, timeout=60, pool_size=10,
+                 cache=None):
+        self.url = url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # the ResponseCache of the requests (see ckanext.geocat.cache)
+        self.cache = cache
+        self.catalog = self._create_catalog()
         self.schema = loader.namespaces['che']
+        self.page_size = page_size
+        # number of pages of a search that are requested concurrently
+        self.workers = workers
 
     def get_id_by_search(self, searchterm='', propertyname='csw:AnyText',
-                         cql=None):
-        """ Returns the found csw dataset with the given searchterm """
-        if cql is None:
-            cql = "%s like '%%%s%%'" % (propertyname, searchterm)
+                         cql=None, esn='brief'):
+        """
+        Returns the ids of the found csw datasets with the given searchterm.
+        By default only the brief records are requested and only their
+        identifiers are parsed, pass another element set name (esn) to
+        request and parse the whole records.
+        """
+        for catalog in self._get_pages(searchterm, propertyname, cql, esn):
+            # return a generator
+            for id in catalog.records:
+                yield id
 
-        nextrecord = 0
-        while nextrecord is not None:
-            self._make_csw_request(cql, startposition=nextrecord)
+    def get_by_search(self, searchterm='', propertyname='csw:AnyText',
+                      cql=None):
+        """
+        Returns the found csw datasets with the given searchterm as
+        (xml, id) tuples, the xml is the serialized record
+        """
+        records = self.get_records_by_search(
+            searchterm,
+            propertyname,
+            cql,
+            esn='full'
+        )
+        for id, datestamp, xml in records:
+            yield xml, id
 
-            log.debug("----------------------------------------")
-            log.debug("CSW Result: %s" % self.catalog.results)
-            log.debug("----------------------------------------")
+    def get_records_by_search(self, searchterm='', propertyname='csw:AnyText',
+                              cql=None, esn='summary'):
+        """
+        Returns the found csw datasets with the given searchterm as
+        (id, datestamp, xml) tuples. The datestamp is the gmd:dateStamp of
+        the record (None if the element set has none), the serialized
+        record is only returned for the 'full' element set, otherwise xml
+        is None.
+        """
+        for catalog in self._get_pages(searchterm, propertyname, cql, esn):
+            for id in catalog.records:
+                xml = None
+                if esn == 'full':
+                    xml = catalog.get_xml(id)
+                yield id, catalog.datestamps.get(id), xml
+
+    def _get_pages(self, searchterm, propertyname, cql, esn):
+        """
+        Requests all pages of the search, yields the catalog of each page
+        in the order of the pages
+        """
+        if cql is None:
+            cql = "%s like '%%%s%%'" % (propertyname, searchterm)
 
-            if (self.catalog.response is None or
-                    self.catalog.results['matches'] == 0):
-                raise DatasetNotFoundError(
-                    "No dataset for the given cql '%s' found" % cql
-                )
+        self._make_csw_request(cql, startposition=0, esn=esn)
+        self._check_page(self.catalog, cql)
+        yield self.catalog
+
+        results = self.catalog.results
+        if results['returned'] == 0 or results['nextrecord'] <= 0:
+            return
+        # the start positions of the other pages are known, if the
+        # server returned a whole page, otherwise follow nextrecord
+        if self.workers > 1 and results['returned'] == self.page_size:
+            pages = self._get_pages_concurrently(
+                cql,
+                esn,
+                range(results['nextrecord'], results['matches'] + 1,
+                      self.page_size)
+            )
+        else:
+            pages = self._get_pages_sequentially(
+                cql,
+                esn,
+                results['nextrecord']
+            )
+        for catalog in pages:
+            yield catalog
 
-            # return a generator
-            for id in self.catalog.records:
-                yield id
+    def _get_pages_sequentially(self, cql, esn, nextrecord):
+        while nextrecord is not None:
+            self._make_csw_request(cql, startposition=nextrecord, esn=esn)
+            self._check_page(self.catalog, cql)
+            yield self.catalog
 
             if (self.catalog.results['returned'] > 0 and
                     self.catalog.results['nextrecord'] > 0):
@@ -801,11 +1365,57 @@ class CswHelper(object):
             else:
                 nextrecord = None
 
-    def _make_csw_request(self, cql, startposition=0):
-        self.catalog.getrecords(
+    def _get_pages_concurrently(self, cql, esn, startpositions):
+        """
+        Requests the pages with a pool of workers, every page gets its own
+        catalog. Only as many pages as there are workers are requested
+        ahead, so the pages held in memory are bounded.
+        """
+        def get_page(startposition):
+            catalog = self._create_catalog()
+            self._make_csw_request(cql, startposition, esn, catalog)
+            return catalog
+
+        pool = ThreadPool(self.workers)
+        try:
+            for start in xrange(0, len(startpositions), self.workers):
+                chunk = startpositions[start:start + self.workers]
+                for catalog in pool.map(get_page, chunk):
+                    self._check_page(catalog, cql)
+                    yield catalog
+        finally:
+            pool.terminate()
+
+    def _create_catalog(self):
+        return GeocatCatalogueServiceWeb(
+            self.url,
+            skip_caps=True,
+            timeout=self.timeout,
+            pool_size=self.pool_size,
+            parse_metadata=False,
+            cache=self.cache
+        )
+
+    def _check_page(self, catalog, cql):
+        log.debug("----------------------------------------")
+        log.debug("CSW Result: %s", catalog.results)
+        log.debug("----------------------------------------")
+
+        if (catalog.response is None or
+                catalog.results['matches'] == 0):
+            raise DatasetNotFoundError(
+                "No dataset for the given cql '%s' found" % cql
+            )
+
+    def _make_csw_request(self, cql, startposition=0, esn='summary',
+                          catalog=None):
+        if catalog is None:
+            catalog = self.catalog
+        catalog.getrecords(
             cql=cql,
+            esn=esn,
             outputschema=self.schema,
-            maxrecords=50,
+            maxrecords=self.page_size,
             startposition=startposition
         )
 
@@ -814,6 +1424,22 @@ class CswHelper(object):
         self.catalog.getrecordbyid(id=[id], outputschema=self.schema)
         return self.catalog.response
 
+    def get_by_ids(self, ids, chunk_size=50):
+        """
+        Returns the csw datasets with the given ids as (xml, id) tuples,
+        the xml is the serialized record. The datasets are requested in
+        chunks of chunk_size ids, ids without dataset are skipped.
+        """
+        ids = list(ids)
+        for start in xrange(0, len(ids), chunk_size):
+            self.catalog.getrecordbyid(
+                id=ids[start:start + chunk_size],
+                esn='full',
+                outputschema=self.schema
+            )
+            for id in self.catalog.records:
+                yield self.catalog.get_xml(id), id
+
 
 class DatasetNotFoundError(Exception):
     pass
@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+"""
+Single pass extraction engine for GeocatDcatDatasetMetadata.
+
+Instead of evaluating every XPath of the dataset mapping against the whole
+document, the document is walked once and every element is dispatched by
+its tag to the rules interested in it. The rules mirror the XPath
+expressions of GeocatDcatDatasetMetadata.get_mapping, the result is the
+same raw dict the XPath engine produces (i.e. before cleaning).
+
+The rules are written by hand for the mapping with MAPPING_DIGEST, the
+engine is only used as long as the mapping has this digest (see supports).
+"""
+import hashlib
+
+from lxml import etree
+
+import ckanext.geocat.xml_loader as loader
+
+_CHILD = 'child'
+_DESCENDANT = 'descendant'
+
+LOCALES = ('#DE', '#FR', '#EN', '#IT', None)
+
+# digest of the dataset mapping the rules below were written for, it has
+# to be updated together with the rules, if the mapping changes
+MAPPING_DIGEST = '96454d8d27ed35e06e1509c71ac9e3fffec0ef0a'
+
+
+def _describe(value):
+    """ Returns the class, config and children of a mapping value """
+    config = value._config if isinstance(value._config, basestring) else None
+    env = sorted(
+        (key, item) for key, item in value.env.iteritems()
+        if key != 'sub_attributes'
+    )
+    return (
+        type(value).__name__,
+        config,
+        env,
+        [_describe(child) for child in value.get_children()],
+    )
+
+
+def get_mapping_digest(mapping):
+    """
+    Returns the digest of the keys, values and XPath expressions of a
+    mapping
+    """
+    description = sorted(
+        (key, _describe(value)) for key, value in mapping.iteritems()
+    )
+    return hashlib.sha1(repr(description)).hexdigest()
+
+
+def supports(mapping):
+    """ Checks if the rules were written for the mapping """
+    return get_mapping_digest(mapping) == MAPPING_DIGEST
+
+
+def _parse_path(path):
+    """
+    Parses a simple location path (only '/' and '//' steps
+    with prefixed names) into a list of (axis, tag) tuples
+    """
+    steps = []
+    axis = _CHILD
+    for part in path.split('/')[1:]:
+        if not part:
+            axis = _DESCENDANT
+            continue
+        prefix, name = part.split(':')
+        steps.append((axis, '{%s}%s' % (loader.namespaces[prefix], name)))
+        axis = _CHILD
+    return steps
+
+
+def _matches(steps, stack, start=0):
+    """
+    Checks if the element on top of the stack is selected by the location
+    path `steps`, evaluated from the parent of stack[start] (or from the
+    document node if start is 0)
+    """
+    def match(step, pos):
+        axis, tag = steps[step]
+        if stack[pos] != tag:
+            return False
+        if step == 0:
+            return axis == _DESCENDANT or pos == start
+        if axis == _CHILD:
+            return pos > start and match(step - 1, pos - 1)
+        for prev in xrange(pos - 1, start - 1, -1):
+            if match(step - 1, prev):
+                return True
+        return False
+
+    return match(len(steps) - 1, len(stack) - 1)
+
+
+def _is_element(node):
+    return isinstance(node.tag, basestring)
+
+
+def _leading_texts(elem):
+    """ Text nodes of elem in front of its first child element """
+    texts = [elem.text] if elem.text else []
+    for child in elem:
+        if _is_element(child):
+            break
+        if child.tail:
+            texts.append(child.tail)
+    return texts
+
+
+def _trailing_texts(elem):
+    """ Text nodes following elem up to its next sibling element """
+    texts = [elem.tail] if elem.tail else []
+    for sibling in elem.itersiblings():
+        if _is_element(sibling):
+            break
+        if sibling.tail:
+            texts.append(sibling.tail)
+    return texts
+
+
+class _Rule(object):
+    """ Collects values from elements selected by a location path """
+    def __init__(self, key, path, locale=None, relative=False):
+        self.key = key
+        self.steps = _parse_path(path)
+        self.tag = self.steps[-1][1]
+        self.locale = locale
+        self.relative = relative
+
+    def selects(self, walker, elem, start=0):
+        if self.locale is not None and elem.get('locale') != self.locale:
+            return False
+        return walker.matches(self.steps, start)
+
+
+class _FirstText(_Rule):
+    """ Equivalent of an XPathValue ending with /text() """
+    def collect(self, walker, elem):
+        def sink(pos, text):
+            walker.values.setdefault(self.key, text)
+        walker.emit_texts(elem, sink)
+
+
+class _AllTexts(_Rule):
+    """ Equivalent of an XPathMultiValue ending with /text() """
+    def collect(self, walker, elem):
+        def sink(pos, text):
+            walker.values.setdefault(self.key, []).append(text)
+        walker.emit_texts(elem, sink)
+
+
+class _FirstAttribute(_Rule):
+    """ Equivalent of an XPathValue ending with /@attribute """
+    def __init__(self, key, path, attribute):
+        super(_FirstAttribute, self).__init__(key, path)
+        self.attribute = attribute
+
+    def collect(self, walker, elem):
+        value = elem.get(self.attribute)
+        if self.key not in walker.values and value is not None:
+            walker.values[self.key] = value
+
+
+class _FirstElement(_Rule):
+    """ Equivalent of an XPathValue selecting an element """
+    def collect(self, walker, elem):
+        if self.key not in walker.values:
+            walker.values[self.key] = elem
+
+
+class _Scope(object):
+    """
+    Describes an element with a predicate on its descendants (e.g.
+    CI_Date[.//CI_DateTypeCode/@codeListValue = "publication"]).
+    While such an element is open, the codes (the values the predicate
+    compares) and all values below it are collected, the predicates
+    are evaluated once the whole document has been walked.
+    """
+    def __init__(self, name, path, code_path, code_attribute=None,
+                 values=None):
+        self.name = name
+        self.steps = _parse_path(path)
+        self.tag = self.steps[-1][1]
+        self.code = _Rule('code', code_path)
+        self.code_attribute = code_attribute
+        self.values = [_Rule(key, value_path)
+                       for key, value_path in (values or [])]
+
+
+class _OpenScope(object):
+    def __init__(self, scope, index, pos):
+        self.scope = scope
+        self.index = index
+        self.pos = pos
+        self.codes = set()
+        self.values = {}
+
+    def first(self, key, locale=None):
+        for pos, value, value_locale in self.values.get(key, []):
+            if locale is None or value_locale == locale:
+                return pos, value
+        return None
+
+
+PUBLISHER_ROLES = ('publisher', 'owner', 'pointOfContact',
+                   'distributor', 'custodian')
+ONLINE_RESOURCE = (
+    '//gmd:distributionInfo/gmd:MD_Distribution//gmd:transferOptions'
+    '//gmd:CI_OnlineResource'
+)
+
+SCOPES = [
+    _Scope(
+        'date',
+        '//gmd:identificationInfo//gmd:citation//gmd:CI_Date',
+        '//gmd:CI_DateTypeCode', code_attribute='codeListValue',
+        values=[
+            ('date', '//gco:DateTime'),
+            ('date', '//gco:Date'),
+        ]
+    ),
+    _Scope(
+        'contact',
+        '//gmd:identificationInfo//gmd:pointOfContact',
+        '//gmd:CI_RoleCode', code_attribute='codeListValue',
+        values=[
+            ('organisation', '//gmd:organisationName/gco:CharacterString'),
+            ('email', '//gmd:address//gmd:electronicMailAddress/gco:CharacterString'),  # noqa
+        ]
+    ),
+    _Scope(
+        'online_resource',
+        ONLINE_RESOURCE,
+        '//gmd:protocol/gco:CharacterString',
+        values=[
+            ('url', '//che:LocalisedURL'),
+            ('description', '//gmd:description/gco:CharacterString'),
+        ]
+    ),
+]
+
+
+def _localised_rules(rule, key, path, locales=('DE', 'FR', 'IT', 'EN')):
+    return [rule('%s_%s' % (key, locale.lower()), path, locale='#' + locale)
+            for locale in locales]
+
+
+RULES = (
+    [
+        _FirstText('identifier', '//gmd:fileIdentifier/gco:CharacterString'),  # noqa
+        _FirstText('spatial', '//gmd:identificationInfo//gmd:extent//gmd:description/gco:CharacterString'),  # noqa
+        _FirstText('temporals_start', '//gmd:identificationInfo//gmd:extent//gmd:temporalElement//gml:TimePeriod/gml:beginPosition'),  # noqa
+        _FirstText('temporals_end', '//gmd:identificationInfo//gmd:extent//gmd:temporalElement//gml:TimePeriod/gml:endPosition'),  # noqa
+        _FirstAttribute('accrual_periodicity', '//gmd:identificationInfo//che:CHE_MD_MaintenanceInformation/gmd:maintenanceAndUpdateFrequency/gmd:MD_MaintenanceFrequencyCode', 'codeListValue'),  # noqa
+        _FirstText('language_identification', '//gmd:identificationInfo//gmd:language/gco:CharacterString'),  # noqa
+        _FirstText('language_metadata', '//che:CHE_MD_Metadata/gmd:language/gco:CharacterString'),  # noqa
+        _FirstElement('contact_organisation', '//gmd:contact//che:CHE_CI_ResponsibleParty//gmd:organisationName/gco:CharacterString'),  # noqa
+        _FirstText('contact_email', '//gmd:contact//che:CHE_CI_ResponsibleParty//gmd:address//gmd:electronicMailAddress/gco:CharacterString'),  # noqa
+        _AllTexts('groups', '//gmd:identificationInfo//gmd:topicCategory/gmd:MD_TopicCategoryCode'),  # noqa
+        _AllTexts('see_alsos', '//gmd:identificationInfo//gmd:aggregationInfo//gmd:aggregateDataSetIdentifier/gmd:MD_Identifier/gmd:code/gco:CharacterString'),  # noqa
+        _FirstText('rights_de', '//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString', locale='#DE', relative=True),  # noqa
+        _FirstText('rights_fr', '//gmd:resourceConstraints//gmd:otherConstraints//gmd:LocalisedCharacterString', locale='#FR', relative=True),  # noqa
+    ] +
+    _localised_rules(_FirstText, 'title', '//gmd:identificationInfo//gmd:citation//gmd:title//gmd:textGroup/gmd:LocalisedCharacterString') +  # noqa
+    _localised_rules(_FirstText, 'description', '//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString') +  # noqa
+    _localised_rules(_AllTexts, 'keywords', '//gmd:identificationInfo//gmd:descriptiveKeywords//gmd:keyword//gmd:textGroup//gmd:LocalisedCharacterString')  # noqa
+)
+
+
+def _dispatch_key(steps):
+    """
+    Paths ending with a child step are dispatched by (parent tag, tag),
+    all others by their tag only
+    """
+    if len(steps) > 1 and steps[-1][0] == _CHILD:
+        return (steps[-2][1], steps[-1][1])
+    return steps[-1][1]
+
+
+def _dispatch_table():
+    """ Builds the dispatch table of the walker """
+    table = {}
+    for rule in RULES:
+        table.setdefault(_dispatch_key(rule.steps), []).append(
+            (_DatasetWalker.handle_rule, rule))
+    for scope in SCOPES:
+        table.setdefault(_dispatch_key(scope.steps), []).append(
+            (_DatasetWalker.open_scope, scope))
+        table.setdefault(_dispatch_key(scope.code.steps), []).append(
+            (_DatasetWalker.handle_code, scope))
+        for rule in scope.values:
+            table.setdefault(_dispatch_key(rule.steps), []).append(
+                (_DatasetWalker.handle_scoped_value, (scope, rule)))
+    return table
+
+
+class _DatasetWalker(object):
+    """ Walks a document once and collects the values of all rules """
+    def __init__(self, xml):
+        self.context = xml
+        self.context_index = None
+        self.stack = []
+        self.path_ids = []
+        # ancestor paths are interned to ids, (path id, tag) -> path id
+        self.interned_paths = {}
+        # results of _matches, (steps id, path id, start) -> bool
+        self.match_results = {}
+        self.pos = 0
+        self.tail_sinks = {}
+        self.values = {}
+        self.open_scopes = []
+        self.scopes = dict((scope.name, []) for scope in SCOPES)
+
+    def walk(self):
+        root = self.context.getroottree().getroot()
+        for event, elem in etree.iterwalk(root, events=('start', 'end')):
+            if event == 'start':
+                self.start(elem)
+            else:
+                self.end(elem)
+
+    def start(self, elem):
+        self.pos += 1
+        self.stack.append(elem.tag)
+        parent_id = self.path_ids[-1] if self.path_ids else None
+        self.path_ids.append(self.interned_paths.setdefault(
+            (parent_id, elem.tag), len(self.interned_paths)))
+        if elem is self.context:
+            self.context_index = len(self.stack) - 1
+        for handler, arg in DISPATCH.get(elem.tag, ()):
+            handler(self, elem, arg)
+        if len(self.stack) > 1:
+            key = (self.stack[-2], elem.tag)
+            for handler, arg in DISPATCH.get(key, ()):
+                handler(self, elem, arg)
+
+    def end(self, elem):
+        depth = len(self.stack) - 1
+        self.tail_sinks.pop(depth, None)
+        sinks = self.tail_sinks.get(depth - 1)
+        if sinks:
+            for text in _trailing_texts(elem):
+                self.pos += 1
+                for sink in sinks:
+                    sink(self.pos, text)
+        while self.open_scopes and self.open_scopes[-1].index == depth:
+            scope = self.open_scopes.pop()
+            self.scopes[scope.scope.name].append(scope)
+        if elem is self.context:
+            self.context_index = None
+        self.stack.pop()
+        self.path_ids.pop()
+
+    def matches(self, steps, start=0):
+        """
+        Cached version of _matches for the current element, elements
+        with the same ancestors in the document share their results
+        """
+        key = (id(steps), self.path_ids[-1], start)
+        try:
+            return self.match_results[key]
+        except KeyError:
+            result = _matches(steps, self.stack, start)
+            self.match_results[key] = result
+            return result
+
+    def emit_texts(self, elem, sink):
+        """
+        Passes the text nodes of elem (i.e. elem/text()) to sink in
+        document order: the leading ones right away, the ones following
+        a child element as soon as the child is closed.
+        """
+        for text in _leading_texts(elem):
+            self.pos += 1
+            sink(self.pos, text)
+        if any(_is_element(child) for child in elem):
+            depth = len(self.stack) - 1
+            self.tail_sinks.setdefault(depth, []).append(sink)
+
+    def handle_rule(self, elem, rule):
+        start = 0
+        if rule.relative:
+            if self.context_index is None:
+                return
+            start = self.context_index + 1
+        if rule.selects(self, elem, start):
+            rule.collect(self, elem)
+
+    def open_scope(self, elem, scope):
+        if self.matches(scope.steps):
+            self.open_scopes.append(
+                _OpenScope(scope, len(self.stack) - 1, self.pos))
+
+    def handle_code(self, elem, scope):
+        for open_scope in self._open(scope):
+            if not scope.code.selects(self, elem, open_scope.index + 1):
+                continue
+            if scope.code_attribute:
+                code = elem.get(scope.code_attribute)
+                if code is not None:
+                    open_scope.codes.add(code)
+            else:
+                self.emit_texts(elem, _add_code(open_scope))
+
+    def handle_scoped_value(self, elem, scoped_rule):
+        scope, rule = scoped_rule
+        for open_scope in self._open(scope):
+            if rule.selects(self, elem, open_scope.index + 1):
+                self.emit_texts(
+                    elem, _add_value(open_scope, rule.key, elem.get('locale'))
+                )
+
+    def _open(self, scope):
+        return [open_scope for open_scope in self.open_scopes
+                if open_scope.scope is scope]
+
+    def first_in_scopes(self, name, code, key, locale=None):
+        """
+        Returns the first value (in document order) below all scopes
+        having the given code, i.e. the result of
+        `//scope[code]//value/text()`
+        """
+        found = [open_scope.first(key, locale)
+                 for open_scope in self.scopes[name]
+                 if code in open_scope.codes]
+        found = [value for value in found if value is not None]
+        if found:
+            return min(found)[1]
+        return ''
+
+
+def _add_code(open_scope):
+    def sink(pos, text):
+        open_scope.codes.add(text)
+    return sink
+
+
+def _add_value(open_scope, key, locale):
+    values = open_scope.values.setdefault(key, [])
+
+    def sink(pos, text):
+        values.append((pos, text, locale))
+    return sink
+
+
+DISPATCH = _dispatch_table()
+
+
+def _first_in_order(*values):
+    for value in values:
+        if value:
+            return value
+    return ''
+
+
+def _array(value):
+    # ArrayValue: elements are expanded, strings are wrapped in a list
+    if isinstance(value, etree._Element):
+        return list(value)
+    return [value]
+
+
+def _element_value(elem):
+    # XPathValue treats elements without children as empty
+    if elem is None or len(elem) == 0:
+        return ''
+    return elem
+
+
+def _localised_url(walker, protocol):
+    for locale in LOCALES:
+        value = walker.first_in_scopes(
+            'online_resource', protocol, 'url', locale)
+        if value:
+            return value
+    return ''
+
+
+def _relations(walker):
+    relations = []
+    for protocol, skip in (('WWW:LINK', 1),
+                           ('WWW:LINK-1.0-http--link', 1),
+                           ('CHTOPO:specialised-geoportal', 0)):
+        resources = sorted(
+            [resource for resource in walker.scopes['online_resource']
+             if protocol in resource.codes],
+            key=lambda resource: resource.pos
+        )
+        for resource in resources[skip:]:
+            url = ''
+            for locale in LOCALES:
+                found = resource.first('url', locale)
+                if found:
+                    url = found[1]
+                    break
+            description = resource.first('description')
+            relations.append([url, description[1] if description else ''])
+    return relations
+
+
+def _role_values(walker, key, fallback):
+    return _first_in_order(*(
+        [walker.first_in_scopes('contact', role, key)
+         for role in PUBLISHER_ROLES] +
+        [fallback]
+    ))
+
+
+def extract_dataset(xml):
+    """
+    Returns the raw dataset values of the given document, exactly like
+    GeocatDcatDatasetMetadata would extract them with the XPath engine
+    """
+    walker = _DatasetWalker(xml)
+    walker.walk()
+    values = walker.values
+
+    dataset = {}
+    for rule in RULES:
+        if rule.key in ('language_identification', 'language_metadata',
+                        'contact_organisation', 'contact_email',
+                        'rights_de', 'rights_fr'):
+            continue
+        dataset[rule.key] = values.get(rule.key) or ''
+
+    dataset['issued'] = _first_in_order(*[
+        walker.first_in_scopes('date', code, 'date')
+        for code in ('publication', 'creation', 'revision')
+    ])
+    dataset['modified'] = walker.first_in_scopes('date', 'revision', 'date')
+    dataset['publishers'] = _array(_role_values(
+        walker, 'organisation',
+        _element_value(values.get('contact_organisation'))
+    ))
+    dataset['contact_points'] = _array(_role_values(
+        walker, 'email', values.get('contact_email', '')
+    ))
+    dataset['language'] = _first_in_order(
+        values.get('language_identification'),
+        values.get('language_metadata'),
+    )
+    dataset['relations'] = _relations(walker)
+    dataset['url'] = _first_in_order(
+        _localised_url(walker, 'WWW:LINK'),
+        _localised_url(walker, 'WWW:LINK-1.0-http--link'),
+    )
+    dataset['coverage'] = ''
+    dataset['rights'] = _first_in_order(
+        values.get('rights_de'),
+        values.get('rights_fr'),
+    )
+    return dataset
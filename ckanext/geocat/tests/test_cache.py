@@ -0,0 +1,110 @@
+"""Tests for the CSW response cache """
+import BaseHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import ckanext.geocat.metadata as metadata
+from ckanext.geocat.cache import ResponseCache
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+__location__ = os.path.realpath(
+    os.path.join(
+        os.getcwd(),
+        os.path.dirname(__file__)
+    )
+)
+
+ETAG = '"record-1"'
+
+
+class CswHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.getheader('if-none-match') == ETAG:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        path = os.path.join(__location__, 'fixtures', 'result_1.xml')
+        with open(path) as xml:
+            body = xml.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        del CswHandler.requests[:]
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CswHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/csw' % self.server.server_address[1]
+
+    def tearDown(self):
+        for session in metadata._sessions.values():
+            session.close()
+        metadata._sessions.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def _get_record(self, cache):
+        csw = metadata.CswHelper(url=self.url, cache=cache)
+        return csw.get_by_id('2466-4690-b54d-c1d958f1c3b8-93814e81')
+
+    def test_fresh_response_is_used_without_request(self):
+        cache = ResponseCache(self.path)
+        xml = self._get_record(cache)
+        self.assertEquals(xml, self._get_record(cache))
+        self.assertEquals(1, len(CswHandler.requests))
+
+    def test_stale_response_is_revalidated(self):
+        cache = ResponseCache(self.path, ttl=0)
+        xml = self._get_record(cache)
+        self.assertEquals(xml, self._get_record(cache))
+        self.assertEquals(2, len(CswHandler.requests))
+        self.assertEquals(ETAG, CswHandler.requests[1].get('if-none-match'))
+
+    def test_least_recently_used_responses_are_evicted(self):
+        cache = ResponseCache(self.path, max_size=25)
+
+        class Response(object):
+            headers = {}
+
+            def __init__(self, content):
+                self.url = 'http://mock-geocat.ch'
+                self.content = content
+
+        cache.put('a', Response('a' * 10))
+        cache.put('b', Response('b' * 10))
+        # a is used after b, so b is the least recently used response
+        os.utime(os.path.join(self.path, 'b.xml'), (1, 1))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', Response('c' * 10))
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEquals(20, cache._size)
+
+        # a new cache counts the size of the directory
+        self.assertEquals(20, ResponseCache(self.path)._size)
@@ -1,9 +1,16 @@
 """Tests for metadata """
 import ckanext.geocat.metadata as metadata
+import ckanext.geocat.xml_loader as loader
+import ckanext.geocat.streaming as streaming
+import ckanext.geocat.values as values
+import ckanext.geocat.xslt as xslt
 from nose.tools import *  # noqa
 import os
 import sys
+from collections import OrderedDict
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from lxml import etree
 import time
 
 if sys.version_info < (2, 7):
@@ -18,6 +25,17 @@ __location__ = os.path.realpath(
     )
 )
 
+# the fixtures extracted by every engine, see _assert_engine_matches_xpath
+ENGINE_FIXTURES = [
+    'complete.xml',
+    'only_de.xml',
+    'publication_date.xml',
+    'publication_date_before_1900.xml',
+    'revision_date.xml',
+    'result_1.xml',
+    'result_2.xml',
+]
+
 
 class TestGeocatDcatDatasetMetadata(unittest.TestCase):
     def _load_xml(self, metadata, filename):
@@ -275,3 +293,474 @@ class TestGeocatDcatDatasetMetadata(unittest.TestCase):
         self.assertEquals(modified.date().isoformat(), '1891-12-31')
 
         self.assertNotEquals(dataset['issued'], dataset['modified'])
+
+    def test_mapping_plan_is_built_once(self):
+        plan = metadata.GeocatDcatDatasetMetadata().get_plan()
+        self.assertIs(plan, metadata.GeocatDcatDatasetMetadata().get_plan())
+
+        mapping = metadata.GeocatDcatDatasetMetadata().get_mapping()
+        self.assertEquals(
+            sorted(mapping.keys()),
+            sorted(key for key, _, _ in plan.steps)
+        )
+        # constant values are folded, they are not evaluated per record
+        self.assertNotIn('coverage', dict(plan))
+        self.assertIn('title_de', dict(plan))
+
+    def test_parse_identifiers_only(self):
+        path = os.path.join(__location__, 'fixtures', 'response_all_results.xml')  # noqa
+        catalog = metadata.GeocatCatalogueServiceWeb(
+            'http://mock-geocat.ch',
+            skip_caps=True
+        )
+        catalog._exml = etree.parse(path)
+        catalog.records = {}
+        catalog._parserecords(loader.namespaces['che'], 'brief')
+
+        self.assertEquals(
+            [
+                '2466-4690-b54d-c1d958f1c3b8-93814e81',
+                '93814e81-2466-4690-b54d-c1d958f1c3b8',
+            ],
+            sorted(catalog.records)
+        )
+        # neither MD_Metadata objects nor elements are built
+        for identifier, record in catalog.records.iteritems():
+            self.assertEquals(identifier, record)
+        self.assertEquals(0, len(catalog.xml_elem))
+
+    def test_get_by_search(self):
+        path = os.path.join(__location__, 'fixtures', 'response_all_results.xml')  # noqa
+        csw = metadata.CswHelper(url='http://mock-geocat.ch')
+        requests = []
+
+        def getrecords(**kwargs):
+            requests.append(kwargs)
+            with open(path) as xml:
+                csw.catalog.response = xml.read()
+            csw.catalog._exml = etree.fromstring(
+                csw.catalog.response
+            ).getroottree()
+            csw.catalog.results = {'matches': 2, 'returned': 2, 'nextrecord': 0}  # noqa
+            csw.catalog.records = OrderedDict()
+            csw.catalog._parserecords(kwargs['outputschema'], kwargs['esn'])
+        csw.catalog.getrecords = getrecords
+
+        records = list(csw.get_by_search(cql="keyword = 'opendata.swiss'"))
+        self.assertEquals(1, len(requests))
+        self.assertEquals('full', requests[0]['esn'])
+        self.assertEquals(
+            [
+                '2466-4690-b54d-c1d958f1c3b8-93814e81',
+                '93814e81-2466-4690-b54d-c1d958f1c3b8',
+            ],
+            [id for xml, id in records]
+        )
+
+        # the serialized records can be extracted like GetRecordById results
+        dcat = metadata.GeocatDcatDatasetMetadata()
+        for xml, id in records:
+            self.assertEquals(id, dcat.get_metadata(xml)['identifier'])
+
+        # summary records are only used for their identifier and date stamp
+        records = list(csw.get_records_by_search(cql="keyword = 'opendata.swiss'"))  # noqa
+        self.assertEquals('summary', requests[-1]['esn'])
+        self.assertEquals(
+            [
+                ('2466-4690-b54d-c1d958f1c3b8-93814e81', '2016-09-02T13:00:20', None),  # noqa
+                ('93814e81-2466-4690-b54d-c1d958f1c3b8', '2016-09-02T13:00:20', None),  # noqa
+            ],
+            records
+        )
+        # no MD_Metadata objects are built
+        for identifier, record in csw.catalog.records.iteritems():
+            self.assertEquals(identifier, record)
+
+    def test_concurrent_pages(self):
+        matches = 7
+        requests = []
+
+        def getrecords(catalog, **kwargs):
+            # the first request starts at 0, like the first page of geocat
+            start = max(kwargs['startposition'], 1)
+            end = min(start + kwargs['maxrecords'], matches + 1)
+            requests.append(start)
+            catalog.response = 'response'
+            catalog.records = OrderedDict(
+                ('id-%d' % position, None) for position in range(start, end)
+            )
+            catalog.results = {
+                'matches': matches,
+                'returned': end - start,
+                'nextrecord': end if end <= matches else 0,
+            }
+
+        original = metadata.GeocatCatalogueServiceWeb.getrecords
+        metadata.GeocatCatalogueServiceWeb.getrecords = getrecords
+        try:
+            expected = ['id-%d' % position for position in range(1, 8)]
+            for workers in (1, 3):
+                del requests[:]
+                csw = metadata.CswHelper(
+                    url='http://mock-geocat.ch',
+                    page_size=2,
+                    workers=workers
+                )
+                self.assertEquals(expected, list(csw.get_id_by_search()))
+                self.assertEquals([1, 3, 5, 7], sorted(requests))
+        finally:
+            metadata.GeocatCatalogueServiceWeb.getrecords = original
+
+    def test_sessions_are_shared_per_endpoint(self):
+        session = metadata.get_session('https://www.geocat.ch/geonetwork/srv/eng/csw')  # noqa
+        self.assertIs(
+            session,
+            metadata.get_session('https://www.geocat.ch/geonetwork/srv/ger/csw-ZH')  # noqa
+        )
+        self.assertIsNot(
+            session,
+            metadata.get_session('http://www.geocat.ch/geonetwork/srv/eng/csw')  # noqa
+        )
+
+    def test_stream_records(self):
+        path = os.path.join(__location__, 'fixtures', 'response_all_results.xml')  # noqa
+        with open(path) as xml:
+            response = xml.read()
+
+        tree, records = metadata.stream_records(response)
+        results = etree.fromstring(response).find('csw:SearchResults', loader.namespaces)  # noqa
+        self.assertEquals(
+            [
+                (
+                    record.find('gmd:fileIdentifier/gco:CharacterString', loader.namespaces).text,  # noqa
+                    '2016-09-02T13:00:20',
+                    etree.tostring(record, encoding='utf-8'),
+                )
+                for record in results
+            ],
+            records
+        )
+        # without serialize only the identifiers and date stamps are read
+        _, records = metadata.stream_records(response, serialize=False)
+        self.assertEquals([None, None], [xml for _, _, xml in records])
+
+        # only the last (cleared) record is left in the tree
+        results = tree.find('csw:SearchResults', loader.namespaces)
+        self.assertEquals('2', results.get('numberOfRecordsMatched'))
+        self.assertEquals(1, len(results))
+        self.assertEquals(0, len(results[0]))
+
+    def _get_page(self, startposition, records, matches):
+        padding = 'x' * 10000
+        record = (
+            '<che:CHE_MD_Metadata xmlns:che="http://www.geocat.ch/2008/che">'
+            '<gmd:fileIdentifier><gco:CharacterString>%d</gco:CharacterString></gmd:fileIdentifier>'  # noqa
+            '<gmd:abstract><gco:CharacterString>%s</gco:CharacterString></gmd:abstract>'  # noqa
+            '</che:CHE_MD_Metadata>'
+        )
+        end = min(startposition + records, matches + 1)
+        return (
+            '<csw:GetRecordsResponse'
+            ' xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"'
+            ' xmlns:gmd="http://www.isotc211.org/2005/gmd"'
+            ' xmlns:gco="http://www.isotc211.org/2005/gco">'
+            '<csw:SearchResults numberOfRecordsMatched="%d"'
+            ' numberOfRecordsReturned="%d" nextRecord="%d">%s'
+            '</csw:SearchResults></csw:GetRecordsResponse>' % (
+                matches,
+                end - startposition,
+                end if end <= matches else 0,
+                ''.join(
+                    record % (position, padding)
+                    for position in range(startposition, end)
+                ),
+            )
+        )
+
+    def test_memory_is_bounded_by_one_page(self):
+        import resource
+        page_size = 50
+        matches = 100 * page_size
+
+        csw = metadata.CswHelper(url='http://mock-geocat.ch',
+                                 page_size=page_size)
+
+        def getrecords(**kwargs):
+            start = max(kwargs['startposition'], 1)
+            csw.catalog._esn = kwargs['esn']
+            csw.catalog.response = self._get_page(start, page_size, matches)
+            csw.catalog._parseresponse()
+            results = csw.catalog._exml.find('csw:SearchResults', loader.namespaces)  # noqa
+            csw.catalog.results = {
+                'matches': int(results.get('numberOfRecordsMatched')),
+                'returned': int(results.get('numberOfRecordsReturned')),
+                'nextrecord': int(results.get('nextRecord')),
+            }
+            csw.catalog.records = OrderedDict()
+            csw.catalog._parserecords(kwargs['outputschema'], kwargs['esn'])
+        csw.catalog.getrecords = getrecords
+
+        records = csw.get_records_by_search(esn='full')
+        # warm up with the first pages
+        for position in xrange(10 * page_size):
+            id, datestamp, xml = next(records)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        count = 10 * page_size
+        for id, datestamp, xml in records:
+            count += 1
+            self.assertEquals(str(count), id)
+            self.assertIn('CHE_MD_Metadata', xml)
+        self.assertEquals(matches, count)
+
+        # about 50 MB of records have been parsed, the peak RSS (in KB)
+        # grows by less than a few pages
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak
+        self.assertLess(growth, 10 * 1024)
+
+    def test_get_by_ids(self):
+        csw = metadata.CswHelper(url='http://mock-geocat.ch')
+        responses = ['result_1.xml', 'result_2.xml']
+        requests = []
+
+        def getrecordbyid(**kwargs):
+            requests.append(kwargs['id'])
+            path = os.path.join(__location__, 'fixtures', responses.pop(0))
+            with open(path) as xml:
+                csw.catalog.response = xml.read()
+            csw.catalog._exml = etree.fromstring(
+                csw.catalog.response
+            ).getroottree()
+            csw.catalog.records = OrderedDict()
+            csw.catalog._parserecords(kwargs['outputschema'], kwargs['esn'])
+        csw.catalog.getrecordbyid = getrecordbyid
+
+        ids = [
+            '2466-4690-b54d-c1d958f1c3b8-93814e81',
+            'missing',
+            '93814e81-2466-4690-b54d-c1d958f1c3b8',
+        ]
+        records = list(csw.get_by_ids(ids, chunk_size=2))
+        self.assertEquals([ids[:2], ids[2:]], requests)
+        self.assertEquals([ids[0], ids[2]], [id for xml, id in records])
+
+        dcat = metadata.GeocatDcatDatasetMetadata()
+        for xml, id in records:
+            self.assertEquals(id, dcat.get_metadata(xml)['identifier'])
+
+    def test_profiling(self):
+        dcat = metadata.GeocatDcatDatasetMetadata()
+        path = os.path.join(__location__, 'fixtures', 'complete.xml')
+        with open(path) as xml:
+            xml_elem = loader.from_string(xml.read())
+
+        dataset = dcat.get_metadata(xml_elem)
+        profile = values.start_profiling()
+        try:
+            self.assertEquals(dataset, dcat.get_metadata(xml_elem))
+        finally:
+            self.assertIs(profile, values.stop_profiling())
+        self.assertIsNone(values.get_profile())
+
+        stats = profile.as_dict()
+        fields = dict((row['field'], row) for row in stats['fields'])
+        title = fields['GeocatDcatDatasetMetadata.title_de']
+        self.assertEquals(1, title['calls'])
+        self.assertEquals(1.0, title['hit_rate'])
+        self.assertTrue(stats['xpaths'])
+        self.assertEquals(
+            sorted(stats['fields'], key=lambda row: -row['seconds']),
+            stats['fields']
+        )
+        # publication date is missing, so issued falls through
+        alternatives = dict(
+            (row['value'], row['alternatives'])
+            for row in stats['first_in_order']
+        )
+        issued = [
+            counts for key, counts in alternatives.iteritems()
+            if key.startswith('GeocatDcatDatasetMetadata.issued')
+        ]
+        self.assertEquals(1, len(issued))
+        self.assertNotIn('0', issued[0])
+        self.assertIn('Field', profile.report())
+
+        # profiling is off again
+        dcat.get_metadata(xml_elem)
+        self.assertEquals(1, profile.fields[
+            'GeocatDcatDatasetMetadata.title_de'
+        ][0])
+
+    def _assert_engine_matches_xpath(self, engine):
+        xpath_dcat = metadata.GeocatDcatDatasetMetadata()
+        engine_dcat = metadata.GeocatDcatDatasetMetadata(engine=engine)
+
+        for filename in ENGINE_FIXTURES:
+            path = os.path.join(__location__, 'fixtures', filename)
+            with open(path) as xml:
+                xml_elem = loader.from_string(xml.read())
+
+            _, xpath_raw = xpath_dcat.load(xml_elem, include_raw=True)
+            _, engine_raw = engine_dcat.load(xml_elem, include_raw=True)
+            self.assertEquals(xpath_raw, engine_raw, filename)
+
+    def test_stream_engine_matches_xpath_engine(self):
+        self._assert_engine_matches_xpath('stream')
+
+    def test_stream_engine_supports_mapping(self):
+        # if this fails, the mapping changed: update the rules of the
+        # stream engine and its MAPPING_DIGEST
+        self.assertTrue(streaming.supports(metadata.dataset_mapping))
+
+        mapping = dict(metadata.dataset_mapping)
+        mapping['spatial'] = values.XPathValue('//gmd:identificationInfo//gmd:extent//gmd:geographicIdentifier//gco:CharacterString/text()')  # noqa
+        self.assertFalse(streaming.supports(mapping))
+
+    def test_xslt_engine_matches_xpath_engine(self):
+        self._assert_engine_matches_xpath('xslt')
+
+    def test_xslt_stylesheet(self):
+        dcat = metadata.GeocatDcatDatasetMetadata(engine='xslt')
+        stylesheet = xslt.get_stylesheet(dcat.get_plan())
+        self.assertIs(stylesheet, xslt.get_stylesheet(dcat.get_plan()))
+
+        compiled = set(stylesheet.values)
+        for localised in stylesheet.bases:
+            compiled.update(localised)
+        mapping = dict(dcat.get_plan())
+
+        # expressions selecting elements are evaluated by the values
+        publishers = mapping['publishers'].get_children()[0].get_children()
+        self.assertIn(publishers[0], compiled)
+        self.assertNotIn(publishers[-1], compiled)
+        # one query for the titles of all locales
+        self.assertIn(mapping['title_de'], compiled)
+        self.assertEquals(
+            1,
+            len([b for b in stylesheet.bases if mapping['title_fr'] in b])
+        )
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            metadata.GeocatDcatDatasetMetadata(engine='unknown')
+
+    def test_concurrent_extraction(self):
+        dcat = metadata.GeocatDcatDatasetMetadata()
+        stream = metadata.GeocatDcatDatasetMetadata(engine='stream')
+        dist = metadata.GeocatDcatDistributionMetadata()
+
+        fixtures = [
+            'complete.xml',
+            'only_de.xml',
+            'publication_date.xml',
+            'revision_date.xml',
+            'result_1.xml',
+        ]
+        documents = []
+        for filename in fixtures:
+            path = os.path.join(__location__, 'fixtures', filename)
+            with open(path) as xml:
+                documents.append(xml.read())
+
+        def extract(xml):
+            context = metadata.ExtractionContext(xml)
+            return (
+                dcat.get_metadata(context),
+                stream.get_metadata(context),
+                dist.get_metadata(context),
+            )
+
+        expected = [extract(xml) for xml in documents]
+
+        # switch threads as often as possible to provoke races
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(extract, documents * 40, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            sys.setcheckinterval(check_interval)
+
+        self.assertEquals(expected * 40, results)
+
+    def test_values_keep_no_state(self):
+        xml = loader.from_string('<root><a>1</a><a>2</a></root>')
+        value = values.ArrayTextValue(values.XPathMultiValue('//a/text()'))
+
+        self.assertEquals('1,2', value.get_value(xml=xml, separator=','))
+        self.assertEquals('1 2', value.get_value(xml=xml))
+        self.assertEquals({}, value.env)
+
+    def test_anchored_xpath(self):
+        xpath = '//gmd:identificationInfo//gmd:title//gmd:LocalisedCharacterString/text() | //gmd:identificationInfo//gmd:abstract//gmd:LocalisedCharacterString/text()'  # noqa
+        anchored = loader.compile_indexed_xpath(xpath)
+        self.assertEquals('//gmd:identificationInfo', anchored.anchor)
+        self.assertIsNone(loader.compile_indexed_xpath('//gmd:identificationInfo//gmd:title | //gmd:contact').anchor)  # noqa
+        self.assertIsNone(loader.compile_indexed_xpath('//gmd:identificationInfoX//gmd:title').anchor)  # noqa
+
+        path = os.path.join(__location__, 'fixtures', 'complete.xml')
+        with open(path) as xml:
+            xml_elem = loader.from_string(xml.read())
+        expected = loader.xpath(xml_elem, xpath)
+        self.assertTrue(expected)
+        self.assertEquals(expected, anchored(xml_elem, loader.DocumentIndex(xml_elem)))  # noqa
+
+        # several anchor nodes: the whole expression is evaluated
+        info = loader.xpath(xml_elem, '//gmd:identificationInfo')[0]
+        info.addnext(loader.from_string(etree.tostring(info)))
+        expected = loader.xpath(xml_elem, xpath)
+        self.assertEquals(expected, anchored(xml_elem, loader.DocumentIndex(xml_elem)))  # noqa
+
+        # no anchor node: the result is empty
+        info.getparent().remove(info.getnext())
+        info.getparent().remove(info)
+        self.assertEquals([], anchored(xml_elem, loader.DocumentIndex(xml_elem)))
+
+    def test_locale_index(self):
+        localised = loader.compile_indexed_xpath('//gmd:identificationInfo//gmd:abstract//gmd:textGroup/gmd:LocalisedCharacterString[@locale="#FR"]/text()')  # noqa
+        self.assertIsInstance(localised, loader.LocalisedXPath)
+        self.assertEquals('#FR', localised.locale)
+        self.assertNotIsInstance(loader.compile_indexed_xpath('//gmd:title//gmd:LocalisedCharacterString[@locale="#FR"]/@locale'), loader.LocalisedXPath)  # noqa
+
+        path = os.path.join(__location__, 'fixtures', 'complete.xml')
+        with open(path) as xml:
+            xml_elem = loader.from_string(xml.read())
+        index = loader.DocumentIndex(xml_elem)
+        for locale in ['#DE', '#FR', '#EN', '#IT', '#RM']:
+            xpath = './/gmd:description//gmd:LocalisedCharacterString[@locale = "%s"]/text()' % locale  # noqa
+            self.assertEquals(
+                loader.xpath(xml_elem, xpath),
+                loader.xpath(xml_elem, xpath, index)
+            )
+        xpath = './/gmd:description//gmd:LocalisedCharacterString/text()'
+        self.assertEquals(
+            loader.xpath(xml_elem, xpath),
+            loader.xpath(xml_elem, xpath, index)
+        )
+        # all locales are answered by the same query
+        self.assertEquals(1, len(index._localised))
+
+    def test_extract_many(self):
+        path = os.path.join(__location__, 'fixtures', 'response_all_results.xml')  # noqa
+        with open(path) as xml:
+            response = xml.read()
+
+        results = metadata.extract_many(response)
+        self.assertEquals(2, len(results))
+
+        records = loader.xpath(response, '//che:CHE_MD_Metadata')
+        for record, (dataset, distributions) in zip(records, results):
+            context = metadata.ExtractionContext(etree.tostring(record))
+            self.assertEquals(
+                metadata.GeocatDcatDatasetMetadata().get_metadata(context),
+                dataset
+            )
+            self.assertEquals(
+                metadata.GeocatDcatDistributionMetadata().get_metadata(context),  # noqa
+                distributions
+            )
+
+        # a list of record elements gives the same result
+        self.assertEquals(results, metadata.extract_many(records))
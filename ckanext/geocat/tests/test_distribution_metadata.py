@@ -122,3 +122,38 @@ class TestGeocatDcatDistributionMetadata(unittest.TestCase):
 
         # coverage
         self.assertEquals('', download.get('coverage'))
+
+    def test_mapping_plan_per_class(self):
+        download = metadata.GeocatDcatDownloadDistributionMetadata()
+        service = metadata.GeocatDcatServiceDistributionMetadata()
+        service_dataset = metadata.GeocatDcatServiceDatasetMetadata()
+
+        self.assertIs(download.get_plan(), metadata.GeocatDcatDownloadDistributionMetadata().get_plan())
+        self.assertIsNot(download.get_plan(), service.get_plan())
+        self.assertIsNot(service.get_plan(), service_dataset.get_plan())
+        self.assertIn('title_de', dict(service_dataset.get_plan()))
+
+    def test_shared_extraction_context(self):
+        path = os.path.join(__location__, 'fixtures', 'complete.xml')
+        with open(path) as xml:
+            context = metadata.ExtractionContext(xml.read())
+
+        dataset_metadata = metadata.GeocatDcatDatasetMetadata()
+        calls = []
+        original_extract = dataset_metadata.extract
+
+        def extract(meta_xml, index=None):
+            calls.append(meta_xml)
+            return original_extract(meta_xml, index)
+        dataset_metadata.extract = extract
+
+        dataset = dataset_metadata.get_metadata(context)
+        distributions = metadata.GeocatDcatDistributionMetadata().get_metadata(context)  # noqa
+
+        self.assertEquals(1, len(calls))
+        self.assertEquals(6, len(distributions))
+        self.assertNotIn('rights', context.dataset)
+
+        # the values returned to the caller are copies of the context values
+        dataset['title']['de'] = 'changed'
+        self.assertNotEquals('changed', context.dataset['title']['de'])
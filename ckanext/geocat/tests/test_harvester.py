@@ -10,6 +10,9 @@ import ckantoolkit.tests.helpers as h
 import ckanext.harvest.model as harvest_model
 from ckanext.harvest import queue
 
+from ckan.model.system_info import get_system_info
+from ckanext.geocat.harvester import LAST_FULL_HARVEST_KEY, \
+    _is_equal_package, _match_resources
 from ckanext.geocat.metadata import CswHelper
 from ckanext.harvest.model import HarvestJob
 
@@ -45,6 +48,38 @@ def _patched_get_id_by_search(self, searchterm='', propertyname='csw:AnyText',
 
 CswHelper.get_id_by_search = _patched_get_id_by_search
 
+original_get_by_search = CswHelper.get_by_search
+
+
+def _patched_get_by_search(self, searchterm='', propertyname='csw:AnyText',
+                           cql=None):
+    httpretty.enable()
+
+    for record in original_get_by_search(self, searchterm, propertyname, cql):
+        yield record
+
+    httpretty.disable()
+
+
+CswHelper.get_by_search = _patched_get_by_search
+
+original_get_records_by_search = CswHelper.get_records_by_search
+
+
+def _patched_get_records_by_search(self, searchterm='',
+                                   propertyname='csw:AnyText', cql=None,
+                                   esn='summary'):
+    httpretty.enable()
+
+    for record in original_get_records_by_search(self, searchterm,
+                                                 propertyname, cql, esn):
+        yield record
+
+    httpretty.disable()
+
+
+CswHelper.get_records_by_search = _patched_get_records_by_search
+
 original_get_by_id = CswHelper.get_by_id
 
 def _patched_get_by_id(self, id):
@@ -58,6 +93,20 @@ def _patched_get_by_id(self, id):
 
 CswHelper.get_by_id = _patched_get_by_id
 
+original_get_by_ids = CswHelper.get_by_ids
+
+
+def _patched_get_by_ids(self, ids, chunk_size=50):
+    httpretty.enable()
+
+    for record in original_get_by_ids(self, ids, chunk_size):
+        yield record
+
+    httpretty.disable()
+
+
+CswHelper.get_by_ids = _patched_get_by_ids
+
 # End monkey patch
 
 
@@ -204,6 +253,225 @@ class TestGeocatHarvestFunctional(FunctionalHarvestTest):
                                       'result_2.xml',
                                   ], 2, 2)
 
+    def test_harvest_create_fetch_in_gather(self):
+        config = json.dumps({'fetch_in_gather': True})
+
+        # no GetRecordById responses, the records are taken from the
+        # GetRecords response
+        self._test_harvest_create('response_all_results.xml', [], 2, 2,
+                                  config=config)
+
+    def test_harvest_create_fetch_batch(self):
+        config = json.dumps({'fetch_batch_size': 10})
+
+        # each mocked response only contains one of the requested records,
+        # the other object is fetched by its own fetch stage
+        self._test_harvest_create('response_all_results.xml',
+                                  [
+                                      'result_1.xml',
+                                      'result_2.xml',
+                                  ], 2, 2, config=config)
+
+    def test_harvest_update(self):
+        results = self._test_harvest_create('response_all_results.xml',
+                                            [
+                                                'result_1.xml',
+                                                'result_2.xml',
+                                            ], 2, 2)
+        self._run_jobs()
+
+        # the existing packages are found in the package index of the
+        # job and updated
+        updated = self._test_harvest_create('response_all_results.xml',
+                                            [
+                                                'result_1.xml',
+                                                'result_2.xml',
+                                            ], 2, 2)
+        eq_(sorted(pkg['id'] for pkg in updated['results']),
+            sorted(pkg['id'] for pkg in results['results']))
+
+    def test_harvest_unchanged_package(self):
+        # the groups of the records exist, so they are stored as well
+        for name in ['territory', 'geography']:
+            h.call_action('group_create', {'user': 'testuser'}, name=name)
+        results = self._test_harvest_create('response_all_results.xml',
+                                            [
+                                                'result_1.xml',
+                                                'result_2.xml',
+                                            ], 2, 2)
+        self._run_jobs()
+
+        # the same records again, the packages are not updated
+        updated = self._test_harvest_create('response_all_results.xml',
+                                            [
+                                                'result_1.xml',
+                                                'result_2.xml',
+                                            ], 2, 2)
+        eq_(sorted(pkg['metadata_modified'] for pkg in updated['results']),
+            sorted(pkg['metadata_modified'] for pkg in results['results']))
+        count = harvest_model.Session.query(harvest_model.HarvestObject) \
+            .filter_by(report_status='not modified').count()
+        eq_(count, 2)
+
+    def test_harvest_incremental(self):
+        config = json.dumps({'incremental': True})
+
+        # the first job is a full harvest
+        harvest_source = self._get_or_create_harvest_source(config=config)
+        self._test_harvest_create('response_all_results.xml',
+                                  [
+                                      'result_1.xml',
+                                      'result_2.xml',
+                                  ], 2, 2, config=config)
+        self._run_jobs()
+
+        last_full_harvest_key = LAST_FULL_HARVEST_KEY + harvest_source['id']
+        full_job_id = get_system_info(last_full_harvest_key)
+        assert_true(full_job_id)
+
+        # the next job only gathers the records modified since then
+        self._mock_csw_results('response_just_one_result.xml',
+                               ['result_1.xml'])
+        self._create_harvest_job(harvest_source['id'])
+        self._run_jobs(harvest_source['id'])
+        self._gather_queue()
+        assert_true("Modified >= '" in httpretty.HTTPretty.last_request.body)
+        eq_(get_system_info(last_full_harvest_key), full_job_id)
+
+    def test_harvest_incremental_after_failed_job(self):
+        config = json.dumps({'incremental': True})
+        harvest_source = self._get_or_create_harvest_source(config=config)
+
+        # the gather stage of the first job fails
+        httpretty.register_uri(httpretty.POST, mock_url, body='<invalid/>')
+        self._create_harvest_job(harvest_source['id'])
+        self._run_jobs(harvest_source['id'])
+        self._gather_queue()
+        self._run_jobs()
+
+        # a failed job is no base for an incremental harvest
+        self._mock_csw_results('response_all_results.xml',
+                               ['result_1.xml', 'result_2.xml'])
+        job = self._create_harvest_job(harvest_source['id'])
+        self._run_jobs(harvest_source['id'])
+        self._gather_queue()
+        assert_true("Modified" not in httpretty.HTTPretty.last_request.body)
+        eq_(get_system_info(LAST_FULL_HARVEST_KEY + harvest_source['id']),
+            job['id'])
+
+    def test_harvest_incremental_after_object_error(self):
+        config = json.dumps({'incremental': True})
+        harvest_source = self._get_or_create_harvest_source(config=config)
+
+        # the second record of the first job can not be imported
+        self._mock_csw_results('response_all_results.xml', ['result_1.xml'])
+        path = os.path.join(__location__, 'fixtures', 'result_1.xml')
+        with open(path) as xml:
+            result = xml.read()
+        httpretty.register_uri(httpretty.GET, mock_url, responses=[
+            httpretty.Response(result),
+            httpretty.Response('<invalid/>'),
+        ])
+        self._run_full_job(harvest_source['id'], num_objects=2)
+        self._run_jobs()
+
+        # the job finished, so the next job is incremental anyway
+        self._mock_csw_results('response_just_one_result.xml',
+                               ['result_1.xml'])
+        self._create_harvest_job(harvest_source['id'])
+        self._run_jobs(harvest_source['id'])
+        self._gather_queue()
+        assert_true("Modified >= '" in httpretty.HTTPretty.last_request.body)
+
+    def test_harvest_skip_unchanged(self):
+        config = json.dumps({'skip_unchanged': True})
+
+        harvest_source = self._get_or_create_harvest_source(config=config)
+        self._test_harvest_create('response_all_results.xml',
+                                  [
+                                      'result_1.xml',
+                                      'result_2.xml',
+                                  ], 2, 2, config=config)
+        self._run_jobs()
+
+        # the date stamps did not change, no object is gathered
+        job = self._create_harvest_job(harvest_source['id'])
+        self._run_jobs(harvest_source['id'])
+        self._gather_queue()
+        count = harvest_model.Session.query(harvest_model.HarvestObject) \
+            .filter_by(harvest_job_id=job['id']).count()
+        eq_(count, 0)
+
+    def test_harvest_skip_unchanged_deleted_package(self):
+        config = json.dumps({'skip_unchanged': True})
+
+        harvest_source = self._get_or_create_harvest_source(config=config)
+        results = self._test_harvest_create('response_all_results.xml',
+                                            [
+                                                'result_1.xml',
+                                                'result_2.xml',
+                                            ], 2, 2, config=config)
+        self._run_jobs()
+        h.call_action('package_delete', id=results['results'][0]['id'])
+
+        # only the record of the deleted package is gathered again,
+        # although its date stamp did not change
+        job = self._create_harvest_job(harvest_source['id'])
+        self._mock_csw_results('response_all_results.xml',
+                               ['result_1.xml', 'result_2.xml'])
+        self._run_jobs(harvest_source['id'])
+        self._gather_queue()
+        count = harvest_model.Session.query(harvest_model.HarvestObject) \
+            .filter_by(harvest_job_id=job['id']).count()
+        eq_(count, 1)
+
+    def test_harvest_skip_unchanged_content(self):
+        config = json.dumps({'skip_unchanged_content': True})
+
+        harvest_source = self._get_or_create_harvest_source(config=config)
+        self._test_harvest_create('response_all_results.xml',
+                                  [
+                                      'result_1.xml',
+                                      'result_2.xml',
+                                  ], 2, 2, config=config)
+        self._run_jobs()
+
+        # the same records again, the import is skipped, but the new
+        # objects are current and linked to the existing packages
+        job = self._create_harvest_job(harvest_source['id'])
+        self._mock_csw_results('response_all_results.xml',
+                               ['result_1.xml', 'result_2.xml'])
+        self._run_jobs(harvest_source['id'])
+        self._gather_queue()
+        self._fetch_queue(2)
+
+        objects = harvest_model.Session.query(harvest_model.HarvestObject) \
+            .filter_by(current=True).all()
+        eq_(len(objects), 2)
+        for harvest_object in objects:
+            eq_(harvest_object.harvest_job_id, job['id'])
+            assert_true(harvest_object.package_id)
+
+    def test_harvest_skip_unchanged_content_deleted_package(self):
+        config = json.dumps({'skip_unchanged_content': True})
+
+        harvest_source = self._get_or_create_harvest_source(config=config)
+        results = self._test_harvest_create('response_all_results.xml',
+                                            [
+                                                'result_1.xml',
+                                                'result_2.xml',
+                                            ], 2, 2, config=config)
+        self._run_jobs()
+        h.call_action('package_delete', id=results['results'][0]['id'])
+
+        # the deleted package is created again, although the content of
+        # its record did not change
+        self._test_harvest_create('response_all_results.xml',
+                                  [
+                                      'result_1.xml',
+                                      'result_2.xml',
+                                  ], 2, 2, config=config)
+
     def test_harvest_deleted_dataset(self):
         test_config_deleted = json.dumps({'delete_missing_datasets': True})
 
@@ -231,3 +499,94 @@ class TestGeocatHarvestFunctional(FunctionalHarvestTest):
 
         error_count = len(last_job_status['object_error_summary'])
         eq_(error_count, 0)
+
+
+class TestPackageDiff(object):
+    stored = {
+        'id': 'package-id',
+        'owner_org': 'organization-id',
+        'organization': {'name': 'geocat_org'},
+        'metadata_modified': '2018-01-01T00:00:00',
+        'title': {'de': u'Gewässer', 'fr': ''},
+        'groups': [
+            {'id': 'geography-id', 'name': 'geography',
+             'title': 'Geography', 'display_name': 'Geography'},
+            {'id': 'territory-id', 'name': 'territory',
+             'title': 'Territory', 'display_name': 'Territory'},
+        ],
+        'keywords': {'de': ['wasser', 'gewasser'], 'fr': []},
+        'relations': [
+            {'url': 'http://geocat.ch/permalink', 'label': 'Permalink'},
+            {'url': 'http://bafu.admin.ch', 'label': 'BAFU'},
+        ],
+        'see_alsos': [{'dataset_identifier': 'linked@geocat_org'}],
+        'spatial': 'Schweiz',
+        'resources': [{'id': 'resource-id', 'url': 'http://geocat.ch',
+                       'position': 0}],
+    }
+
+    def _get_pkg_dict(self, **kwargs):
+        pkg_dict = {
+            'id': 'package-id',
+            'owner_org': 'geocat_org',
+            'title': {'de': u'Gewässer'},
+            'see_alsos': [{'dataset_identifier': 'linked@geocat_org'}],
+            'groups': [{'name': 'territory'}, {'name': 'geography'}],
+            'keywords': {'de': ['gewasser', 'wasser'], 'fr': []},
+            'relations': [
+                {'url': 'http://bafu.admin.ch', 'label': 'BAFU'},
+                {'url': 'http://geocat.ch/permalink', 'label': 'Permalink'},
+            ],
+            'spatial': 'Schweiz',
+            'resources': [{'url': 'http://geocat.ch'}],
+        }
+        pkg_dict.update(kwargs)
+        return pkg_dict
+
+    def test_unchanged_package(self):
+        assert_true(_is_equal_package(self._get_pkg_dict(), self.stored))
+
+    def test_changed_package(self):
+        for changes in [
+                {'title': {'de': u'Gewässer', 'fr': u'Eaux'}},
+                {'see_alsos': []},
+                {'groups': [{'name': 'territory'}]},
+                {'groups': [{'name': 'territory'}, {'name': 'health'}]},
+                {'keywords': {'de': ['wasser', 'wasser'], 'fr': []}},
+                {'relations': [
+                    {'url': 'http://bafu.admin.ch', 'label': 'BAFU'}]},
+                {'publishers': [{'label': 'BAFU'}]},
+                {'resources': [{'url': 'http://geocat.ch/new'}]},
+                {'resources': []}]:
+            pkg_dict = self._get_pkg_dict(**changes)
+            assert_true(not _is_equal_package(pkg_dict, self.stored))
+
+    def test_removed_field(self):
+        # a field missing in the new package is empty
+        pkg_dict = self._get_pkg_dict()
+        del pkg_dict['spatial']
+        assert_true(not _is_equal_package(pkg_dict, self.stored))
+
+        stored = dict(self.stored, title={'de': u'Gewässer', 'fr': u'Eaux'})
+        assert_true(not _is_equal_package(self._get_pkg_dict(), stored))
+
+
+class TestResourceMatching(object):
+    def test_match_resources(self):
+        stored = [
+            {'id': 'download', 'url': 'http://geocat.ch/data.zip',
+             'download_url': 'http://geocat.ch/data.zip'},
+            {'id': 'service', 'url': 'http://geocat.ch/data.zip',
+             'download_url': ''},
+            {'id': 'removed', 'url': 'http://geocat.ch/wms',
+             'download_url': ''},
+        ]
+        resources = [
+            {'url': 'http://geocat.ch/data.zip', 'download_url': ''},
+            {'url': 'http://geocat.ch/wfs', 'download_url': ''},
+            {'url': 'http://geocat.ch/data.zip',
+             'download_url': 'http://geocat.ch/data.zip'},
+        ]
+        _match_resources(resources, stored)
+        eq_([resource.get('id') for resource in resources],
+            ['service', None, 'download'])
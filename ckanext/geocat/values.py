@@ -1,3 +1,6 @@
+import json
+import threading
+import time
 from lxml import etree
 from ckan.lib.munge import munge_title_to_name
 import ckanext.geocat.xml_loader as loader
@@ -6,99 +9,310 @@ import logging
 log = logging.getLogger(__name__)
 
 
+class Profile(object):
+    """
+    Statistics of the evaluated values, collected while profiling is
+    enabled (see start_profiling). For every mapping key and every XPath
+    expression the number of calls, the cumulative time and the number of
+    hits (non-empty values) are recorded. For FirstInOrderValues the
+    alternative that returned the value is counted (None if none did).
+    """
+    def __init__(self):
+        self.fields = {}
+        self.xpaths = {}
+        self.first_in_order = {}
+        self._lock = threading.Lock()
+
+    def _add(self, stats, key, seconds, hit):
+        with self._lock:
+            entry = stats.setdefault(key, [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            if hit:
+                entry[2] += 1
+
+    def add_field(self, key, seconds, value):
+        self._add(self.fields, key, seconds, bool(value))
+
+    def add_xpath(self, xpath, seconds, value):
+        self._add(self.xpaths, xpath, seconds, bool(value))
+
+    def add_alternative(self, key, position):
+        with self._lock:
+            counts = self.first_in_order.setdefault(key, {})
+            counts[position] = counts.get(position, 0) + 1
+
+    def as_dict(self):
+        """ Returns the statistics as a dict that can be dumped as JSON """
+        def rows(stats, name):
+            return [
+                {
+                    name: key,
+                    'calls': calls,
+                    'seconds': seconds,
+                    'hits': hits,
+                    'hit_rate': float(hits) / calls,
+                }
+                for key, (calls, seconds, hits) in _by_time(stats)
+            ]
+        return {
+            'fields': rows(self.fields, 'field'),
+            'xpaths': rows(self.xpaths, 'xpath'),
+            'first_in_order': [
+                {
+                    'value': key,
+                    'alternatives': dict(
+                        (str(position), count)
+                        for position, count in counts.iteritems()
+                    ),
+                }
+                for key, counts in sorted(self.first_in_order.iteritems())
+            ],
+        }
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def report(self, limit=None):
+        """ Returns the statistics as text, sorted by cumulative time """
+        lines = []
+        for title, stats in (('Field', self.fields), ('XPath', self.xpaths)):
+            lines.append('%8s %10s %8s  %s' % ('calls', 'ms', 'hits', title))
+            for key, (calls, seconds, hits) in _by_time(stats)[:limit]:
+                lines.append('%8d %10.2f %7d%%  %s' % (
+                    calls,
+                    seconds * 1000,
+                    100 * hits / calls,
+                    key
+                ))
+            lines.append('')
+        lines.append('FirstInOrderValue alternatives (position: count)')
+        for key, counts in sorted(self.first_in_order.iteritems()):
+            lines.append('%s: %s' % (key, ', '.join(
+                '%s: %d' % (position, counts[position])
+                for position in sorted(counts)
+            )))
+        return '\n'.join(lines)
+
+
+def _by_time(stats):
+    return sorted(stats.iteritems(), key=lambda item: -item[1][1])
+
+
+# the active profile, profiling is disabled if it is None
+_profile = None
+
+
+def start_profiling():
+    """ Enables profiling of all values, returns the new Profile """
+    global _profile
+    _profile = Profile()
+    return _profile
+
+
+def stop_profiling():
+    """ Disables profiling, returns the collected Profile """
+    global _profile
+    profile, _profile = _profile, None
+    return profile
+
+
+def get_profile():
+    """ Returns the active Profile or None """
+    return _profile
+
+
 class Value(object):
+    """
+    A value is configured once and can then be evaluated any number of
+    times, also from several threads at once. The keyword arguments of
+    the constructor are defaults of the environment, the keyword arguments
+    of get_value (e.g. the xml) only exist for the duration of that call.
+    """
+    defaults = {}
+
     def __init__(self, config, **kwargs):
         self._config = config
         self.env = kwargs
 
+    def get_env(self, kwargs):
+        """ Returns a new environment for one evaluation """
+        env = dict(self.defaults)
+        env.update(self.env)
+        env.update(kwargs)
+        return env
+
     def get_value(self, **kwargs):
         """ Abstract method to return the value of the attribute """
         raise NotImplementedError
 
+    def get_children(self):
+        """ Returns the values this value is combined of """
+        return []
+
+    def is_constant(self):
+        """ Returns True if the value does not depend on the document """
+        return False
+
 
 class StringValue(Value):
     def get_value(self, **kwargs):
         return self._config
 
+    def is_constant(self):
+        return True
+
 
 class XmlValue(Value):
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        xml = self.env['xml']
-        return etree.tostring(xml)
+        env = self.get_env(kwargs)
+        return etree.tostring(env['xml'])
 
 
 class XPathValue(Value):
-    def get_element(self, xml, xpath):
-        result = loader.xpath(xml, xpath)
+    defaults = {'empty_value': ''}
+
+    def __init__(self, config, **kwargs):
+        super(XPathValue, self).__init__(config, **kwargs)
+        self._xpath = loader.compile_indexed_xpath(config)
+
+    def get_element(self, xml, xpath, index=None):
+        return self.select(loader.xpath(xml, xpath, index))
+
+    def select(self, result):
+        """ Returns the value from the result of the XPath expression """
         if len(result) > 0:
             return result[0]
         return []
 
     def get_value(self, **kwargs):
-        self.env.update({'empty_value': ''})
-        self.env.update(kwargs)
-        xml = self.env['xml']
+        env = self.get_env(kwargs)
+        xml = env['xml']
 
         xpath = self._config
-        log.debug("XPath: %s" % (xpath))
-
+        # results of a precompiled engine (e.g. XSLT) by value
+        results = env.get('results')
+        # results of the expressions already evaluated on this node
+        memo = env.get('memo')
+        profile = _profile
+        if profile is not None:
+            start = time.time()
         try:
-            value = self.get_element(xml, xpath)
+            if results is not None and self in results:
+                value = self.select(results[self])
+            elif memo is not None:
+                try:
+                    result = memo[xpath]
+                except KeyError:
+                    result = loader.xpath(xml, self._xpath, env.get('index'))
+                    memo[xpath] = result
+                value = self.select(result)
+            else:
+                value = self.get_element(xml, self._xpath, env.get('index'))
         except etree.XPathError, e:
-            log.debug('XPath not found: %s, error: %s' % (xpath, str(e)))
+            log.debug('XPath not found: %s, error: %s', xpath, e)
             value = ''
+        if profile is not None:
+            profile.add_xpath(xpath, time.time() - start, value)
 
         if len(value) == 0 or value is None or not value:
-            value = self.env['empty_value']
+            value = env['empty_value']
         return value
 
 
 class XPathMultiValue(XPathValue):
-    def get_element(self, xml, xpath):
-        return loader.xpath(xml, xpath)
+    def select(self, result):
+        return list(result)
 
 
 class XPathSubValue(Value):
+    def __init__(self, config, **kwargs):
+        super(XPathSubValue, self).__init__(config, **kwargs)
+        self._xpath = loader.compile_indexed_xpath(config)
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        sub_attributes = self.env.get('sub_attributes', [])
+        env = self.get_env(kwargs)
+        sub_attributes = env.get('sub_attributes', [])
         value = []
-        for xml_elem in loader.xpath(self.env['xml'], self._config):  # noqa
+
+        # a precompiled engine returns the results of the
+        # sub attributes for each selected element
+        results = env.get('results')
+        if results is not None and self in results:
+            for sub_results in results[self]:
+                sub_kwargs = dict(kwargs, results=sub_results, memo={})
+                value.append(
+                    [sub.get_value(**sub_kwargs) for sub in sub_attributes]
+                )
+            return value
+
+        index = env.get('index')
+        for xml_elem in loader.xpath(env['xml'], self._xpath, index):
             sub_values = []
-            kwargs['xml'] = xml_elem
+            sub_kwargs = dict(kwargs, xml=xml_elem, memo={})
             for sub in sub_attributes:
-                sub_values.append(sub.get_value(**kwargs))
+                sub_values.append(sub.get_value(**sub_kwargs))
             value.append(sub_values)
         return value
 
+    def get_children(self):
+        return list(self.env.get('sub_attributes', []))
+
 
 class CombinedValue(Value):
+    defaults = {'separator': ' '}
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
+        env = self.get_env(kwargs)
         value = ''
-        separator = self.env['separator'] if 'separator' in self.env else ' '
+        separator = env['separator']
         for attribute in self._config:
             new_value = attribute.get_value(**kwargs)
             if new_value is not None:
-                value = value + attribute.get_value(**kwargs) + separator
+                value = value + new_value + separator
         return value.strip(separator)
 
+    def get_children(self):
+        return list(self._config)
+
+    def is_constant(self):
+        return all(child.is_constant() for child in self.get_children())
+
 
 class FirstInOrderValue(Value):
+    defaults = {'empty_value': ''}
+
     def get_value(self, **kwargs):
-        self.env.update({'empty_value': ''})
-        self.env.update(kwargs)
-        for attribute in self._config:
+        env = self.get_env(kwargs)
+        profile = _profile
+        for position, attribute in enumerate(self._config):
             value = attribute.get_value(**kwargs)
             if value:
+                if profile is not None:
+                    profile.add_alternative(self.get_label(env), position)
                 return value
-        return self.env['empty_value']
+        if profile is not None:
+            profile.add_alternative(self.get_label(env), None)
+        return env['empty_value']
+
+    def get_label(self, env):
+        """ Identifies the value in a profile by field and first XPath """
+        first = self._config[0] if self._config else None
+        return '%s: %s' % (
+            env.get('field'),
+            getattr(first, '_config', type(first).__name__)
+        )
+
+    def get_children(self):
+        return list(self._config)
+
+    def is_constant(self):
+        return all(child.is_constant() for child in self.get_children())
 
 
 class ArrayValue(Value):
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
         value = []
         for attribute in self._config:
             new_value = attribute.get_value(**kwargs)
@@ -117,13 +331,26 @@ class ArrayValue(Value):
                 value.append(new_value)
         return value
 
+    def get_children(self):
+        return list(self._config)
+
+    def is_constant(self):
+        return all(child.is_constant() for child in self.get_children())
+
 
 class ArrayTextValue(Value):
+    defaults = {'separator': ' '}
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
+        env = self.get_env(kwargs)
         values = self._config.get_value(**kwargs)
-        separator = self.env['separator'] if 'separator' in self.env else ' '
-        return separator.join(values)
+        return env['separator'].join(values)
+
+    def get_children(self):
+        return [self._config]
+
+    def is_constant(self):
+        return all(child.is_constant() for child in self.get_children())
 
 
 class ArrayDictNameValue(ArrayValue):
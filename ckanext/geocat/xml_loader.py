@@ -1,3 +1,4 @@
+import re
 from lxml import etree
 
 
@@ -24,10 +25,223 @@ namespaces = {
 }
 
 
-def xpath(xml, xpath):
+_compiled_xpaths = {}
+
+
+def compile_xpath(xpath):
+    """
+    Returns a compiled XPath evaluator for the given expression.
+    Evaluators are cached, so every expression is only compiled
+    once per process.
+    """
+    try:
+        return _compiled_xpaths[xpath]
+    except KeyError:
+        compiled = etree.XPath(xpath, namespaces=namespaces)
+        _compiled_xpaths[xpath] = compiled
+        return compiled
+
+
+def xpath(xml, xpath, index=None):
     if isinstance(xml, basestring):
         xml = from_string(xml)
-    return xml.xpath(xpath, namespaces=namespaces)
+    if index is not None:
+        if not isinstance(xpath, AnchoredXPath):
+            xpath = compile_indexed_xpath(xpath)
+        return xpath(xml, index)
+    if isinstance(xpath, AnchoredXPath):
+        return xpath(xml)
+    if not isinstance(xpath, etree.XPath):
+        xpath = compile_xpath(xpath)
+    return xpath(xml)
+
+
+# Subtrees most of the mapping paths start with. Paths starting with one
+# of them are evaluated relative to the anchor node, see AnchoredXPath
+ANCHORS = (
+    '//gmd:identificationInfo',
+    '//gmd:distributionInfo/gmd:MD_Distribution',
+)
+
+# Texts of localised elements, optionally of one locale,
+# e.g. .//gmd:LocalisedCharacterString[@locale = "#DE"]/text()
+LOCALISED = re.compile(
+    r'^(?P<base>[^|]*/(?:gmd:LocalisedCharacterString|che:LocalisedURL))'
+    r'(?:\[@locale\s*=\s*"(?P<locale>[^"]*)"(?:\s+and\s+\./text\(\))?\]'
+    r'|\[\./text\(\)\])?'
+    r'/text\(\)$'
+)
+
+
+class DocumentIndex(object):
+    """
+    Caches the nodes of one document that are needed by many
+    expressions: the anchor nodes and the texts of localised elements
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+        self._anchors = {}
+        self._localised = {}
+
+    def anchor(self, anchor):
+        try:
+            return self._anchors[anchor]
+        except KeyError:
+            nodes = xpath(self.xml, anchor)
+            self._anchors[anchor] = nodes
+            return nodes
+
+    def localised(self, base, xml):
+        """
+        Returns all texts selected by the base expression from the given
+        node and the same texts grouped by the locale of their element
+        """
+        key = (base, xml)
+        try:
+            return self._localised[key]
+        except KeyError:
+            texts = base(xml, self)
+            locales = {}
+            for text in texts:
+                element = text.getparent()
+                if text.is_tail:
+                    element = element.getparent()
+                locales.setdefault(element.get('locale'), []).append(text)
+            self._localised[key] = (texts, locales)
+            return texts, locales
+
+
+class AnchoredXPath(object):
+    """
+    A compiled XPath expression, that is evaluated relative to its anchor
+    node, if the expression starts with one of the ANCHORS.
+
+    //gmd:identificationInfo//gmd:title selects the same nodes as
+    .//gmd:title evaluated on the identificationInfo node, as long as the
+    document has exactly one such node. Without an anchor node the result
+    is empty, with several the whole expression is evaluated.
+    """
+
+    def __init__(self, xpath):
+        self.xpath = compile_xpath(xpath)
+        self.anchor, relative = split_anchor(xpath)
+        if self.anchor is not None:
+            self.relative = compile_xpath(relative)
+
+    def __call__(self, xml, index=None):
+        if self.anchor is None or index is None:
+            return self.xpath(xml)
+        nodes = index.anchor(self.anchor)
+        if len(nodes) == 1:
+            return self.relative(nodes[0])
+        if not nodes:
+            return []
+        return self.xpath(xml)
+
+
+class LocalisedXPath(AnchoredXPath):
+    """
+    An expression selecting the texts of localised elements. All locales
+    are selected with one query and grouped in the document index, so the
+    expressions of the other locales are answered from the index as well.
+    """
+
+    def __init__(self, xpath, base, locale):
+        super(LocalisedXPath, self).__init__(xpath)
+        self.base = compile_anchored_xpath(base + '/text()')
+        self.locale = locale
+
+    def __call__(self, xml, index=None):
+        if index is None:
+            return self.xpath(xml)
+        texts, locales = index.localised(self.base, xml)
+        if self.locale is None:
+            return list(texts)
+        return list(locales.get(self.locale, []))
+
+
+_anchored_xpaths = {}
+
+
+def compile_anchored_xpath(xpath):
+    """ Returns a cached AnchoredXPath for the given expression """
+    try:
+        return _anchored_xpaths[xpath]
+    except KeyError:
+        compiled = AnchoredXPath(xpath)
+        _anchored_xpaths[xpath] = compiled
+        return compiled
+
+
+_indexed_xpaths = {}
+
+
+def compile_indexed_xpath(xpath):
+    """
+    Returns a cached evaluator for the given expression, that uses the
+    document index if one is passed
+    """
+    try:
+        return _indexed_xpaths[xpath]
+    except KeyError:
+        match = LOCALISED.match(xpath)
+        if match:
+            compiled = LocalisedXPath(
+                xpath,
+                match.group('base'),
+                match.group('locale')
+            )
+        else:
+            compiled = compile_anchored_xpath(xpath)
+        _indexed_xpaths[xpath] = compiled
+        return compiled
+
+
+def split_anchor(xpath):
+    """
+    Returns the anchor of the expression and the expression relative to
+    it, or (None, xpath) if not all parts of the union start with the same
+    anchor
+    """
+    found = None
+    relative = []
+    for part in split_union(xpath):
+        part = part.strip()
+        for anchor in ANCHORS:
+            rest = part[len(anchor):]
+            if part.startswith(anchor) and rest.startswith('/'):
+                break
+        else:
+            return None, xpath
+        if found not in (None, anchor):
+            return None, xpath
+        found = anchor
+        relative.append('.' + rest)
+    return found, ' | '.join(relative)
+
+
+def split_union(xpath):
+    """ Splits the expression at the | operators outside of predicates """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, char in enumerate(xpath):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '[(':
+            depth += 1
+        elif char in '])':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            parts.append(xpath[start:i])
+            start = i + 1
+    parts.append(xpath[start:])
+    return parts
 
 
 def from_string(xml_string):
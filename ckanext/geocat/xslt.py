@@ -0,0 +1,202 @@
+"""
+XSLT engine for the extraction of a mapping.
+
+The XPath expressions of a mapping plan are compiled into one XSLT
+stylesheet. The stylesheet writes the results of all expressions into a
+small intermediate document, from which the values of the plan are then
+evaluated without querying the metadata document again.
+
+Only expressions selecting text nodes or attributes are compiled, all other
+expressions (e.g. selecting elements) are still evaluated by the values.
+"""
+import re
+import threading
+from lxml import etree
+
+import ckanext.geocat.xml_loader as loader
+from ckanext.geocat.values import XPathValue, XPathMultiValue, XPathSubValue
+
+XSL_NAMESPACE = 'http://www.w3.org/1999/XSL/Transform'
+
+# expressions whose nodes have a string value equal to the lxml result
+TEXT_OR_ATTRIBUTE = re.compile(r'/(text\(\)|@[\w:.-]+)$')
+
+
+def _xsl(parent, tag, **attributes):
+    tag = '{%s}%s' % (XSL_NAMESPACE, tag)
+    return etree.SubElement(parent, tag, attributes)
+
+
+def _anchored(xpath):
+    """
+    Replaces the anchors (see xml_loader.ANCHORS) at the start of the
+    expression by variables, so the anchor nodes are only searched once
+    """
+    parts = []
+    for part in loader.split_union(xpath):
+        part = part.strip()
+        for number, anchor in enumerate(loader.ANCHORS):
+            rest = part[len(anchor):]
+            if part.startswith(anchor) and rest.startswith('/'):
+                part = '$anchor%d%s' % (number, rest)
+                break
+        parts.append(part)
+    return ' | '.join(parts)
+
+
+def _is_compilable(xpath):
+    for part in loader.split_union(xpath):
+        if not TEXT_OR_ATTRIBUTE.search(part.strip()):
+            return False
+    try:
+        loader.compile_xpath(xpath)
+    except etree.XPathSyntaxError:
+        return False
+    return True
+
+
+class Stylesheet(object):
+    """ The stylesheet generated from a mapping plan """
+
+    def __init__(self, plan):
+        self.values = []
+        # localised values are selected by one query per base expression
+        # and output element (see xml_loader.LocalisedXPath)
+        self.bases = []
+        self._base_outputs = {}
+        self.document = etree.Element(
+            '{%s}stylesheet' % XSL_NAMESPACE,
+            nsmap=dict(loader.namespaces, xsl=XSL_NAMESPACE),
+            version='1.0'
+        )
+        # only the namespaces of the expressions, not of the output
+        self.document.set(
+            'exclude-result-prefixes',
+            ' '.join(sorted(loader.namespaces))
+        )
+        template = _xsl(self.document, 'template', match='/')
+        for number, anchor in enumerate(loader.ANCHORS):
+            _xsl(template, 'variable', name='anchor%d' % number, select=anchor)
+        root = etree.SubElement(template, 'r')
+        for key, attribute in plan:
+            self._add(root, attribute)
+        self._local = threading.local()
+
+    def _add(self, parent, value):
+        """ Adds the compilable expressions of the value to the output """
+        if isinstance(value, XPathSubValue):
+            self._add_sub_value(parent, value)
+        elif isinstance(value, XPathValue):
+            self._add_xpath_value(parent, value)
+        else:
+            for child in value.get_children():
+                self._add(parent, child)
+
+    def _add_xpath_value(self, parent, value):
+        if not _is_compilable(value._config):
+            return
+        if isinstance(value._xpath, loader.LocalisedXPath):
+            self._add_localised_value(parent, value)
+            return
+        select = _anchored(value._config)
+        if not isinstance(value, XPathMultiValue):
+            select = '(%s)[1]' % select
+        output = self._output(parent, value)
+        for_each = _xsl(output, 'for-each', select=select)
+        _xsl(etree.SubElement(for_each, 'i'), 'value-of', select='.')
+
+    def _add_localised_value(self, parent, value):
+        base = value._xpath.base.xpath.path
+        key = (parent, base)
+        if key not in self._base_outputs:
+            output = etree.SubElement(parent, 'v', b=str(len(self.bases)))
+            self.bases.append([])
+            for_each = _xsl(output, 'for-each', select=_anchored(base))
+            item = etree.SubElement(for_each, 'i')
+            locale = _xsl(item, 'if', test='../@locale')
+            _xsl(
+                _xsl(locale, 'attribute', name='l'),
+                'value-of',
+                select='../@locale'
+            )
+            _xsl(item, 'value-of', select='.')
+            self._base_outputs[key] = output
+        output = self._base_outputs[key]
+        self.bases[int(output.get('b'))].append(value)
+
+    def _add_sub_value(self, parent, value):
+        # the sub attributes are evaluated relative to the selected
+        # elements, so all of them must be compiled
+        if not all(self._is_leaf_tree(sub) for sub in value.get_children()):
+            return
+        output = self._output(parent, value)
+        for_each = _xsl(output, 'for-each', select=_anchored(value._config))
+        group = etree.SubElement(for_each, 's')
+        for sub in value.get_children():
+            self._add(group, sub)
+
+    def _is_leaf_tree(self, value):
+        """ Checks if all XPath expressions of the value can be compiled """
+        if isinstance(value, XPathSubValue):
+            return False
+        if isinstance(value, XPathValue):
+            return _is_compilable(value._config)
+        return all(self._is_leaf_tree(child) for child in value.get_children())
+
+    def _output(self, parent, value):
+        output = etree.SubElement(parent, 'v', n=str(len(self.values)))
+        self.values.append(value)
+        return output
+
+    def get_transform(self):
+        # the XSLT object is not shared between threads
+        try:
+            return self._local.transform
+        except AttributeError:
+            self._local.transform = etree.XSLT(self.document)
+            return self._local.transform
+
+    def evaluate(self, xml):
+        """
+        Applies the stylesheet to the document, returns the results of
+        the compiled values as dict, to be passed to get_value as 'results'
+        """
+        # the absolute expressions refer to the whole document, like the
+        # XPath expressions evaluated on any of its elements
+        output = self.get_transform()(xml.getroottree()).getroot()
+        return self._read(output)
+
+    def _read(self, output):
+        results = {}
+        for elem in output:
+            if elem.get('b') is not None:
+                self._read_localised(elem, results)
+                continue
+            value = self.values[int(elem.get('n'))]
+            if isinstance(value, XPathSubValue):
+                results[value] = [self._read(group) for group in elem]
+            else:
+                results[value] = [item.text or '' for item in elem]
+        return results
+
+    def _read_localised(self, elem, results):
+        items = [(item.get('l'), item.text or '') for item in elem]
+        for value in self.bases[int(elem.get('b'))]:
+            locale = value._xpath.locale
+            results[value] = [
+                text for item_locale, text in items
+                if locale is None or item_locale == locale
+            ]
+
+
+_stylesheets = {}
+
+
+def get_stylesheet(plan):
+    """ Returns the stylesheet of the plan, it is only generated once """
+    try:
+        return _stylesheets[plan]
+    except KeyError:
+        stylesheet = Stylesheet(plan)
+        _stylesheets[plan] = stylesheet
+        return stylesheet